@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Build the index of the wheels in the any-charm wheelhouse.
+
+The index lists the name, version, compatible tags and dependencies of every wheel, so the charm
+can resolve python-packages against the wheelhouse without opening the wheels. Only the standard
+library is used since it runs in the charmcraft wheelhouse part.
+"""
+
+import email.parser
+import json
+import pathlib
+import re
+import sys
+import zipfile
+
+INDEX_FILENAME = "index.json"
+INDEX_VERSION = 1
+
+
+def wheel_tags(filename: str) -> list:
+    """Expand the compressed tag sets in a wheel filename into a list of tags."""
+    python_tags, abi_tags, platform_tags = filename[: -len(".whl")].split("-")[-3:]
+    return [
+        f"{python_tag}-{abi_tag}-{platform_tag}"
+        for python_tag in python_tags.split(".")
+        for abi_tag in abi_tags.split(".")
+        for platform_tag in platform_tags.split(".")
+    ]
+
+
+def wheel_index_entry(wheel: pathlib.Path) -> dict:
+    """Create the index entry of a wheel."""
+    with zipfile.ZipFile(wheel) as wheel_zip:
+        metadata_file = next(
+            name
+            for name in wheel_zip.namelist()
+            if name.count("/") == 1 and name.endswith(".dist-info/METADATA")
+        )
+        metadata = email.parser.BytesParser().parsebytes(
+            wheel_zip.read(metadata_file), headersonly=True
+        )
+    return {
+        "name": re.sub(r"[-_.]+", "-", metadata["Name"]).lower(),
+        "version": metadata["Version"],
+        "filename": wheel.name,
+        "tags": wheel_tags(wheel.name),
+        "requires_dist": metadata.get_all("Requires-Dist") or [],
+    }
+
+
+def main(wheelhouse_dir: pathlib.Path):
+    """Write the index of the wheels in the wheelhouse directory."""
+    wheels = [wheel_index_entry(wheel) for wheel in sorted(wheelhouse_dir.glob("*.whl"))]
+    index = {"version": INDEX_VERSION, "wheels": wheels}
+    (wheelhouse_dir / INDEX_FILENAME).write_text(json.dumps(index, indent=2), encoding="utf-8")
+
+
+if __name__ == "__main__":
+    main(pathlib.Path(sys.argv[1]))
@@ -3,76 +3,998 @@
 
 """The base class for AnyCharm to provide the default functionality of any-charm."""
 
+import base64
+import collections
+import collections.abc
+import functools
+import gzip
 import json
 import logging
-from typing import Iterator
+import math
+import os
+import pathlib
+import re
+import secrets
+import tempfile
+import time
+import typing
+import zlib
+from typing import Any, Dict, List, Optional
 
 import ops
-import yaml
+
+from file_utils import append_bounded_log, file_digest, write_file_atomic
 
 logger = logging.getLogger(__name__)
 
 __all__ = ["AnyCharmBase"]
 
+# each action result value is passed to action-set as one command line argument,
+# which Linux limits to 128 KiB
+RESULT_CHUNK_SIZE = 100000
+RESULT_FILE_DIR = pathlib.Path(tempfile.gettempdir()) / "any-charm-results"
+RESULT_FILE_KEEP = 16
+# streamed rpc methods report progress through action-log at most once per interval
+RPC_PROGRESS_INTERVAL = 1.0
+RPC_PROGRESS_PREVIEW_SIZE = 200
+RPC_STATUS_COMPLETE = "complete"
+RPC_STATUS_DEADLINE_EXCEEDED = "deadline-exceeded"
+# written by the charm.py entrypoint, relative to the charm directory
+HOOK_STATS_FILENAME = ".any-charm-hook-stats"
+PROFILE_REQUEST_FILENAME = ".any-charm-profile-request"
+PROFILE_DIRNAME = ".any-charm-profiles"
+RELATION_CHANGES_FILENAME = ".any-charm-relation-changes"
+RELATION_SNAPSHOT_FILENAME = ".any-charm-relation-snapshot"
+RELATION_CHANGES_MAX_SIZE = 1024 * 1024
+RELATION_CHANGES_KEEP = 1000
+RELATION_LOAD_FILENAME = ".any-charm-relation-load"
+RELATION_LOAD_MAX_SIZE = 1024 * 1024
+RELATION_LOAD_KEEP = 100
+# the peer unit databag key to request the other units to generate the same relation load
+RELATION_LOAD_REQUEST_KEY = "relation-load-request"
+PEER_ENDPOINT = "peer-any"
+# written by the charm.py entrypoint in the reset action dispatch
+RESET_REPORT_FILENAME = ".any-charm-reset"
+SECRET_CACHE_FILENAME = ".any-charm-secret-cache"
+SECRET_CACHE_KEEP = 256
+# secret:<id> or secret://<model-uuid>/<id>, the id is an xid in Juju
+SECRET_URI_PATTERN = re.compile(r"secret:(?://[0-9a-f-]+/)?[0-9a-z-]+")
+# unit databag keys set by Juju itself
+JUJU_UNIT_DATABAG_KEYS = frozenset(("egress-subnets", "ingress-address", "private-address"))
+
+
+def _percentiles(samples: List[float]) -> Dict[str, Any]:
+    """Summarize samples with count, p50, p95 and max."""
+    ordered = sorted(samples)
+
+    def _percentile(percent: int) -> float:
+        return ordered[max(0, math.ceil(len(ordered) * percent / 100) - 1)]
+
+    return {
+        "count": len(ordered),
+        "p50": _percentile(50),
+        "p95": _percentile(95),
+        "max": ordered[-1],
+    }
+
+
+def _aggregate_hook_stats(records: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Aggregate the dispatch records of the hook stats ring buffer per event."""
+    samples: Dict[str, Dict[str, List[float]]] = {}
+    for record in records:
+        event_samples = samples.setdefault(record["event"], {"hook-tool-calls": []})
+        for phase, duration in record["phases"].items():
+            event_samples.setdefault(phase, []).append(duration)
+        event_samples["hook-tool-calls"].append(sum(record["hook-tool-calls"].values()))
+    return {
+        event: {
+            "count": len(event_samples["hook-tool-calls"]),
+            "hook-tool-calls": _percentiles(event_samples.pop("hook-tool-calls")),
+            "phases": {
+                phase: _percentiles(durations) for phase, durations in event_samples.items()
+            },
+        }
+        for event, event_samples in samples.items()
+    }
+
+
+class _ResultWriter:
+    """Incremental encoder of a JSON action result value.
+
+    The json encoding sets the JSON as the result value. The zlib encoding compresses the
+    JSON, then splits the base64 encoded payload across the {key}-chunk-{index} results.
+    The file encoding writes the JSON into a gzip file on the unit and returns its path,
+    size and sha256 checksum instead. Only the json encoding holds the JSON text in memory.
+    """
+
+    def __init__(self, key: str, encoding: str):
+        self.key = key
+        self.encoding = encoding
+        self.written = 0
+        self._parts: List[str] = []
+        self._compressor = zlib.compressobj() if encoding == "zlib" else None
+        self._path: Optional[pathlib.Path] = None
+        self._file: Optional[typing.TextIO] = None
+        if encoding == "file":
+            RESULT_FILE_DIR.mkdir(parents=True, exist_ok=True)
+            result_files = sorted(RESULT_FILE_DIR.iterdir(), key=lambda f: f.stat().st_mtime)
+            for stale_file in result_files[: max(0, len(result_files) - RESULT_FILE_KEEP + 1)]:
+                stale_file.unlink(missing_ok=True)
+            self._path = RESULT_FILE_DIR / f"{key}-{secrets.token_hex(8)}.json.gz"
+            self._file = gzip.open(self._path, "wt", encoding="utf-8")
+
+    def write(self, text: str):
+        """Append a fragment of the JSON text."""
+        self.written += len(text)
+        if self._file is not None:
+            self._file.write(text)
+        elif self._compressor is not None:
+            self._parts.append(self._compressor.compress(text.encode("utf-8")))
+        else:
+            self._parts.append(text)
+
+    def close(self):
+        """Close the result file of the file encoding, if any."""
+        if self._file is not None:
+            self._file.close()
+
+    def results(self) -> Dict[str, str]:
+        """Finish the JSON text and get the action results holding it."""
+        key = self.key
+        if self._path is not None:
+            self.close()
+            return {
+                f"{key}-encoding": "file",
+                f"{key}-path": str(self._path),
+                f"{key}-size": str(self._path.stat().st_size),
+                f"{key}-sha256": file_digest(self._path),
+            }
+        if self._compressor is None:
+            return {key: "".join(self._parts)}
+        self._parts.append(self._compressor.flush())
+        payload = base64.b64encode(b"".join(self._parts)).decode("ascii")
+        chunk_starts = range(0, len(payload), RESULT_CHUNK_SIZE)
+        results = {f"{key}-encoding": "zlib", f"{key}-chunks": str(len(chunk_starts))}
+        for idx, start in enumerate(chunk_starts):
+            end = start + RESULT_CHUNK_SIZE
+            results[f"{key}-chunk-{idx}"] = payload[start:end]
+        return results
+
+
+def _encode_result(key: str, result_json: str, encoding: str) -> Dict[str, str]:
+    """Encode a JSON action result value into action results, see _ResultWriter."""
+    writer = _ResultWriter(key, encoding)
+    writer.write(result_json)
+    return writer.results()
+
+
+class _RpcDeadlineExceeded(Exception):
+    """The deadline of the rpc action passed before the method finished."""
+
+
+def _remaining(deadline: Optional[float]) -> Optional[float]:
+    """Get the seconds left until a monotonic clock deadline, raising if it has passed."""
+    if deadline is None:
+        return None
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise _RpcDeadlineExceeded()
+    return remaining
+
+
+def _iterate_async(agen: collections.abc.AsyncIterator, deadline: Optional[float]):
+    """Iterate an async generator on a private event loop, bounded by the deadline."""
+    import asyncio
+
+    loop = asyncio.new_event_loop()
+    try:
+        while True:
+            try:
+                timeout = _remaining(deadline)
+                yield loop.run_until_complete(asyncio.wait_for(agen.__anext__(), timeout))
+            except StopAsyncIteration:
+                return
+            except asyncio.TimeoutError as exc:
+                raise _RpcDeadlineExceeded() from exc
+    finally:
+        try:
+            loop.run_until_complete(agen.aclose())
+        except Exception:
+            logger.debug("error while closing async generator", exc_info=True)
+        loop.close()
+
+
+def _await(coroutine: collections.abc.Coroutine, deadline: Optional[float]) -> Any:
+    """Run a coroutine on a private event loop, bounded by the deadline."""
+    import asyncio
+
+    loop = asyncio.new_event_loop()
+    try:
+        try:
+            timeout = _remaining(deadline)
+        except _RpcDeadlineExceeded:
+            coroutine.close()
+            raise
+        return loop.run_until_complete(asyncio.wait_for(coroutine, timeout))
+    except asyncio.TimeoutError as exc:
+        raise _RpcDeadlineExceeded() from exc
+    finally:
+        loop.close()
+
+
+def _secret_key(secret_id: str) -> str:
+    """Get the xid of a secret URI, the same secret has a short and a model qualified URI."""
+    return secret_id.rpartition("/")[2].rpartition(":")[2]
+
+
+def _databag_diff(previous: Dict[str, str], current: Dict[str, str]) -> Dict[str, Any]:
+    """Calculate the keys set to a new value and the keys removed between two databags."""
+    return {
+        "changed": {key: value for key, value in current.items() if previous.get(key) != value},
+        "removed": sorted(set(previous) - set(current)),
+    }
+
 
 class AnyCharmBase(ops.CharmBase):
     """Charm the service."""
 
+    # methods served by the unit-local rpc server when the rpc-server config is set, they're
+    # called without the ops framework and must not use the Juju model
+    RPC_SERVER_METHODS: typing.Tuple[str, ...] = ()
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        with open("metadata.yaml", encoding="utf-8") as metadata_fo:
-            metadata = yaml.safe_load(metadata_fo)
-        self.__relations = list(metadata["provides"]) + list(metadata["requires"])
+        # hook tools called by the charm itself rather than through the ops model
+        self.hook_tool_calls: typing.Counter[str] = collections.Counter()
         self.framework.observe(self.on.get_relation_data_action, self._get_relation_data_)
         self.framework.observe(self.on.rpc_action, self._rpc_)
+        self.framework.observe(self.on.get_hook_stats_action, self._get_hook_stats_)
+        self.framework.observe(self.on.profile_hooks_action, self._profile_hooks_)
+        self.framework.observe(self.on.get_relation_changes_action, self._get_relation_changes_)
+        self.framework.observe(self.on.relation_load_action, self._relation_load_)
+        self.framework.observe(self.on.reset_action, self._reset_)
         self.framework.observe(self.on.start, self._on_start_)
+        self.framework.observe(self.on.secret_changed, self._on_secret_changed_)
+        self.framework.observe(self.on.config_changed, self._on_relation_load_trigger_)
+        self.framework.observe(self.on.update_status, self._on_relation_load_trigger_)
+        for endpoint in self.__observed_relation_endpoints():
+            self.framework.observe(self.on[endpoint].relation_changed, self._on_relation_changed_)
+            self.framework.observe(
+                self.on[endpoint].relation_departed, self._on_relation_departed_
+            )
+            self.framework.observe(self.on[endpoint].relation_broken, self._on_relation_broken_)
+
+    @functools.cached_property
+    def relation_endpoints(self) -> List[str]:
+        """Names of all provides and requires endpoints of the charm."""
+        return [*self.meta.provides, *self.meta.requires]
+
+    @functools.cached_property
+    def interface_endpoints(self) -> Dict[str, List[str]]:
+        """Index of provides and requires endpoint names by the relation interface name."""
+        index: Dict[str, List[str]] = {}
+        for endpoint in self.relation_endpoints:
+            index.setdefault(self.meta.relations[endpoint].interface_name, []).append(endpoint)
+        return index
+
+    @functools.cached_property
+    def __goal_state(self) -> Optional[ops.hookcmds.GoalState]:
+        self.hook_tool_calls["goal-state"] += 1
+        try:
+            return ops.hookcmds.goal_state()
+        except (ops.hookcmds.Error, OSError):
+            # the goal-state hook tool isn't available outside of Juju, like under the Harness,
+            # the endpoints are probed one by one instead
+            logger.warning("goal-state failed")
+            return None
+
+    @functools.cached_property
+    def active_relation_endpoints(self) -> List[str]:
+        """Names of the provides and requires endpoints that currently have relations.
+
+        The endpoints are discovered with a single goal-state hook tool call instead of one
+        relation-ids call per endpoint, and cached for the rest of the dispatch.
+        """
+        goal_state = self.__goal_state
+        if goal_state is None:
+            return list(self.relation_endpoints)
+        return [
+            endpoint for endpoint in self.relation_endpoints if endpoint in goal_state.relations
+        ]
+
+    @functools.cached_property
+    def app_unit_names(self) -> List[str]:
+        """Names of the units of this application that are not dying."""
+        goal_state = self.__goal_state
+        if goal_state is None:
+            return [f"{self.app.name}/{idx}" for idx in range(self.app.planned_units())]
+        return [name for name, goal in goal_state.units.items() if goal.status != "dying"]
+
+    @functools.cached_property
+    def active_relations(self) -> List[ops.Relation]:
+        """All relations of the provides and requires endpoints of the charm."""
+        return [
+            relation
+            for relation_name in self.active_relation_endpoints
+            for relation in self.model.relations[relation_name]
+        ]
+
+    def __observed_relation_endpoints(self) -> List[str]:
+        # observing the relation events of all endpoints takes tens of milliseconds, in a Juju
+        # dispatch only the relation events of the dispatched relation hook can be emitted
+        if "JUJU_DISPATCH_PATH" not in os.environ:
+            return list(self.meta.relations)
+        endpoint = os.environ.get("JUJU_RELATION")
+        return [endpoint] if endpoint else []
+
+    def __log_hook_tool_calls(self, action_name: str):
+        logger.debug(
+            "%s action made %s direct hook tool calls: %s",
+            action_name,
+            sum(self.hook_tool_calls.values()),
+            dict(self.hook_tool_calls),
+        )
 
     def _on_start_(self, event):
         self.unit.status = ops.ActiveStatus()
 
-    def __relation_iter(self) -> Iterator[ops.Relation]:
-        for relation_name in self.__relations:
-            for relation in self.model.relations[relation_name]:
-                yield relation
+    def _on_secret_changed_(self, event: ops.SecretChangedEvent):
+        # a new revision of the secret has been published, the cached content is outdated
+        cache_path = self.charm_dir / SECRET_CACHE_FILENAME
+        if not event.secret.id or not cache_path.exists():
+            return
+        cache = json.loads(cache_path.read_text(encoding="utf-8"))
+        if cache.pop(_secret_key(event.secret.id), None) is not None:
+            write_file_atomic(cache_path, json.dumps(cache).encode("utf-8"), mode=0o600)
+
+    def __record_relation_changes(
+        self, relation: ops.Relation, event: str, databags: Optional[Dict[str, Any]] = None
+    ) -> List[Dict[str, Any]]:
+        """Append the key level diffs of relation databags to the relation changes log.
+
+        The last recorded content of every databag is kept in a snapshot file to diff against.
+        A None databag records the removal of all its keys, and no databags records the removal
+        of all databags of the relation.
+        """
+        snapshot_path = self.charm_dir / RELATION_SNAPSHOT_FILENAME
+        snapshot = {"seq": 0, "relations": {}}
+        if snapshot_path.exists():
+            snapshot = json.loads(snapshot_path.read_text(encoding="utf-8"))
+        relation_snapshot = snapshot["relations"].setdefault(str(relation.id), {})
+        if databags is None:
+            databags = dict.fromkeys(relation_snapshot)
+        records = []
+        for entity, databag in databags.items():
+            diff = _databag_diff(relation_snapshot.get(entity, {}), databag or {})
+            if databag is None:
+                relation_snapshot.pop(entity, None)
+            else:
+                relation_snapshot[entity] = databag
+            if not diff["changed"] and not diff["removed"]:
+                continue
+            snapshot["seq"] += 1
+            records.append(
+                {
+                    "seq": snapshot["seq"],
+                    "time": time.time(),
+                    "event": event,
+                    "relation": relation.name,
+                    "relation-id": relation.id,
+                    "entity": entity,
+                    **diff,
+                }
+            )
+        if not relation_snapshot:
+            del snapshot["relations"][str(relation.id)]
+        if records:
+            append_bounded_log(
+                self.charm_dir / RELATION_CHANGES_FILENAME,
+                [json.dumps(record) for record in records],
+                RELATION_CHANGES_MAX_SIZE,
+                RELATION_CHANGES_KEEP,
+            )
+        write_file_atomic(snapshot_path, json.dumps(snapshot).encode("utf-8"))
+        return records
+
+    def _on_relation_changed_(self, event: ops.RelationChangedEvent):
+        entity = event.unit or event.app
+        if entity is None:
+            return
+        try:
+            databag = dict(event.relation.data[entity])
+            records = self.__record_relation_changes(
+                event.relation, "changed", {entity.name: databag}
+            )
+        except Exception:
+            logger.exception("error while recording relation changes")
+            return
+        if event.relation.name == PEER_ENDPOINT and any(
+            RELATION_LOAD_REQUEST_KEY in record["changed"] for record in records
+        ):
+            request = json.loads(databag[RELATION_LOAD_REQUEST_KEY])
+            self.__run_relation_load(request["load"], f"requested by {entity.name}")
+
+    def _on_relation_departed_(self, event: ops.RelationDepartedEvent):
+        if event.departing_unit is None:
+            return
+        try:
+            self.__record_relation_changes(
+                event.relation, "departed", {event.departing_unit.name: None}
+            )
+        except Exception:
+            logger.exception("error while recording relation changes")
+
+    def _on_relation_broken_(self, event: ops.RelationBrokenEvent):
+        try:
+            self.__record_relation_changes(event.relation, "broken")
+        except Exception:
+            logger.exception("error while recording relation changes")
+
+    @staticmethod
+    def __project(databag: ops.RelationDataContent, keys: List[str]) -> Dict[str, str]:
+        if not keys:
+            return dict(databag)
+        return {key: value for key, value in databag.items() if key in keys}
 
-    def __extrack_relation_unit_data(self, relation: ops.Relation):
+    def __extrack_relation_unit_data(self, relation: ops.Relation, keys: List[str]):
         data = {}
         for unit in relation.units:
-            data[unit.name] = dict(relation.data[unit])
-        for unit_idx in range(self.app.planned_units()):
-            unit_name = f"{self.app.name}/{unit_idx}"
+            data[unit.name] = self.__project(relation.data[unit], keys)
+        for unit_name in self.app_unit_names:
             unit = self.model.get_unit(unit_name)
-            data[unit_name] = dict(relation.data[unit])
+            data[unit_name] = self.__project(relation.data[unit], keys)
         return data
 
-    def _get_relation_data_(self, event):
-        try:
-            relation_data_list = []
-            for relation in self.__relation_iter():
-                relation_data_list.append(
+    def __extrack_relation_data(self, relation: ops.Relation, params: Dict[str, Any]):
+        relation_data = {"relation": relation.name, "other_application_name": relation.app.name}
+        keys = json.loads(params["keys"])
+        if params["data"] in ("all", "application"):
+            relation_data["application_data"] = {
+                self.app.name: self.__project(relation.data[self.app], keys),
+                relation.app.name: self.__project(relation.data[relation.app], keys),
+            }
+        if params["data"] in ("all", "unit"):
+            relation_data["unit_data"] = self.__extrack_relation_unit_data(relation, keys)
+        return relation_data
+
+    def __secret_references(self, relation_data_list: List[Dict[str, Any]]) -> Dict[str, bool]:
+        """Find the secret URIs in the extracted databags, mapped to whether they're only local.
+
+        Secrets referenced only by the databags of this application and its units are owned by
+        this charm most likely.
+        """
+        local_entities = {self.app.name, *self.app_unit_names}
+        references: Dict[str, bool] = {}
+        for relation_data in relation_data_list:
+            for databags in (
+                relation_data.get("application_data", {}),
+                relation_data.get("unit_data", {}),
+            ):
+                for entity, databag in databags.items():
+                    for value in databag.values():
+                        if SECRET_URI_PATTERN.fullmatch(value):
+                            local = references.get(value, True) and entity in local_entities
+                            references[value] = local
+        return references
+
+    def resolve_secrets(
+        self, secret_ids: List[str], uncached: typing.Collection[str] = ()
+    ) -> Dict[str, Dict[str, Any]]:
+        """Get the latest content of secrets, fetching each secret at most once.
+
+        The content of consumed secrets is cached on the unit across dispatches, until Juju
+        reports a new revision of the secret with the secret-changed event. The cache keeps the
+        SECRET_CACHE_KEEP most recently fetched secrets. Secrets owned by this charm don't get
+        a secret-changed event for their own revisions, so they should be passed as uncached.
+
+        Args:
+            secret_ids: the secret URIs to resolve, duplicates are resolved once.
+            uncached: the secret URIs to fetch again even if they're cached.
+
+        Returns:
+            A {"content": {...}} or {"error": ...} object for each secret URI.
+        """
+        cache_path = self.charm_dir / SECRET_CACHE_FILENAME
+        cache = {}
+        if cache_path.exists():
+            cache = json.loads(cache_path.read_text(encoding="utf-8"))
+        cache_updated = False
+        uncached_keys = {_secret_key(secret_id) for secret_id in uncached}
+        resolved_keys: Dict[str, Dict[str, Any]] = {}
+        for secret_id in secret_ids:
+            key = _secret_key(secret_id)
+            if key in resolved_keys:
+                continue
+            if key in cache and key not in uncached_keys:
+                resolved_keys[key] = {"content": cache[key]["content"]}
+                continue
+            try:
+                # refresh to track the latest revision, so secret-changed is emitted for the
+                # next revision, at the cost of a second secret-get
+                secret = self.model.get_secret(id=secret_id)
+                content = secret.get_content(refresh=True)
+            except ops.ModelError as exc:
+                resolved_keys[key] = {"error": repr(exc)}
+            else:
+                resolved_keys[key] = {"content": content}
+                cache[key] = {"content": content, "time": time.time()}
+                cache_updated = True
+        if cache_updated:
+            recent = sorted(cache, key=lambda cached: cache[cached]["time"])[-SECRET_CACHE_KEEP:]
+            write_file_atomic(
+                cache_path,
+                json.dumps({key: cache[key] for key in recent}).encode("utf-8"),
+                mode=0o600,
+            )
+        return {secret_id: resolved_keys[_secret_key(secret_id)] for secret_id in secret_ids}
+
+    def __select_relations(self, params: Dict[str, Any]) -> List[ops.Relation]:
+        endpoint = params.get("relation")
+        relations = self.model.relations[endpoint] if endpoint else self.active_relations
+        application = params.get("application")
+        if application:
+            relations = [relation for relation in relations if relation.app.name == application]
+        relations = sorted(relations, key=lambda relation: relation.id)
+        if params["cursor"]:
+            relations = [relation for relation in relations if relation.id > int(params["cursor"])]
+        return relations
+
+    def update_relation_data(self, updates: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Bring the databags of this unit or application in many relations to a desired content.
+
+        Each update is a {"relation", "application", "relation_id", "app", "data", "replace"}
+        object. The relation endpoint, remote application and relation id select the relations,
+        all relations are selected if none of them is given. The data is written to the
+        application databag if app is true, or to the unit databag otherwise. Keys with an empty
+        or null value in data are removed, and if replace is true, all keys not in data too.
+
+        The updates of the same databag are merged, then only the keys whose value differs from
+        the current content are written, with a single relation-set per databag, so remote units
+        are not woken up by redundant writes.
+
+        Args:
+            updates: the desired content of the databags.
+
+        Returns:
+            A {"relation", "relation_id", "databag", "changed", "removed"} object for each
+            databag that was actually changed.
+        """
+        desired_databags: Dict[Any, Dict[str, str]] = {}
+        databags: Dict[Any, ops.RelationDataContent] = {}
+        for update in updates:
+            relations = self.__select_relations(
+                {
+                    "relation": update.get("relation"),
+                    "application": update.get("application"),
+                    "cursor": "",
+                }
+            )
+            if update.get("relation_id") is not None:
+                relations = [r for r in relations if r.id == update["relation_id"]]
+            entity = self.app if update.get("app") else self.unit
+            for relation in relations:
+                target = (relation.name, relation.id, entity.name)
+                databags[target] = relation.data[entity]
+                desired = desired_databags.setdefault(target, dict(databags[target]))
+                if update.get("replace"):
+                    desired.clear()
+                desired.update(update["data"])
+        changes = []
+        for target, desired in desired_databags.items():
+            diff = _databag_diff(
+                dict(databags[target]), {key: value for key, value in desired.items() if value}
+            )
+            if not diff["changed"] and not diff["removed"]:
+                continue
+            databags[target].update({**diff["changed"], **dict.fromkeys(diff["removed"], "")})
+            relation_name, relation_id, databag = target
+            changes.append(
+                {"relation": relation_name, "relation_id": relation_id, "databag": databag, **diff}
+            )
+        return changes
+
+    def reset_relation_data(self) -> List[Dict[str, Any]]:
+        """Remove the relation data written by this unit, and this application if it's the leader.
+
+        All the keys of the databags in the active relations and the peer relation are removed,
+        except the unit addresses set by Juju, with a single relation-set per databag.
+
+        Returns:
+            A {"relation", "relation_id", "databag", "changed", "removed"} object for each
+            databag that was actually changed, like update_relation_data.
+        """
+        entities: List[Any] = [self.unit]
+        if self.unit.is_leader():
+            entities.append(self.app)
+        changes = []
+        for relation in [*self.active_relations, *self.model.relations[PEER_ENDPOINT]]:
+            for entity in entities:
+                databag = relation.data[entity]
+                removed = sorted(key for key in databag if key not in JUJU_UNIT_DATABAG_KEYS)
+                if not removed:
+                    continue
+                databag.update(dict.fromkeys(removed, ""))
+                changes.append(
                     {
                         "relation": relation.name,
-                        "other_application_name": relation.app.name,
-                        "application_data": {
-                            self.app.name: dict(relation.data[self.app]),
-                            relation.app.name: dict(relation.data[relation.app]),
-                        },
-                        "unit_data": self.__extrack_relation_unit_data(relation),
+                        "relation_id": relation.id,
+                        "databag": entity.name,
+                        "changed": {},
+                        "removed": removed,
                     }
                 )
-            event.set_results({"relation-data": json.dumps(relation_data_list)})
+        return changes
+
+    def generate_relation_load(
+        self,
+        keys: int = 10,
+        value_size: int = 64,
+        iterations: int = 1,
+        rate: float = 0,
+        endpoints: Optional[List[str]] = None,
+        app: bool = False,
+        peers: bool = False,
+    ) -> Dict[str, Any]:
+        """Rewrite relation data to put relation churn load on the related charms.
+
+        Each iteration writes new random values to the load-0 to load-{keys - 1} keys of the
+        unit databag, or the application databag if app is true, in every relation of the
+        endpoints, all active relations by default. The iterations are paced to rate iterations
+        per second, or run back to back if rate is 0. Juju publishes the relation data written
+        by a dispatch when the dispatch finishes, use the relation-load config to rewrite the
+        keys in every config-changed and update-status dispatch for sustained churn.
+
+        The latency of each relation-set is recorded, the latency distribution of the recent
+        loads is returned by the relation-load action.
+
+        Args:
+            keys: number of keys written per databag.
+            value_size: number of characters of each value.
+            iterations: number of times the keys are rewritten.
+            rate: target iterations per second, 0 for no pacing.
+            endpoints: names of the endpoints to write to.
+            app: write the application databags instead of the unit databags.
+            peers: request the other units of the application to generate the same load, via
+                the peer-any relation.
+
+        Returns:
+            The number of relations, writes and bytes written, the duration and the latency
+            distribution of the writes.
+        """
+        if peers:
+            load = {
+                "keys": keys,
+                "value_size": value_size,
+                "iterations": iterations,
+                "rate": rate,
+                "endpoints": endpoints,
+                "app": app,
+            }
+            request = json.dumps({"load": load, "nonce": secrets.token_hex(8)})
+            for relation in self.model.relations[PEER_ENDPOINT]:
+                relation.data[self.unit][RELATION_LOAD_REQUEST_KEY] = request
+        relations = [
+            relation
+            for endpoint in endpoints or self.active_relation_endpoints
+            for relation in self.model.relations[endpoint]
+        ]
+        entity = self.app if app else self.unit
+        latencies = []
+        start = time.monotonic()
+        for iteration in range(iterations):
+            if rate:
+                time.sleep(max(0.0, start + iteration / rate - time.monotonic()))
+            for relation in relations:
+                data = {
+                    f"load-{idx}": secrets.token_hex(value_size // 2 + 1)[:value_size]
+                    for idx in range(keys)
+                }
+                write_start = time.monotonic()
+                relation.data[entity].update(data)
+                latencies.append(time.monotonic() - write_start)
+        summary = {
+            "relations": len(relations),
+            "writes": len(latencies),
+            "bytes": len(latencies) * keys * value_size,
+            "duration": time.monotonic() - start,
+            "latency": _percentiles(latencies) if latencies else None,
+        }
+        append_bounded_log(
+            self.charm_dir / RELATION_LOAD_FILENAME,
+            [json.dumps({"time": time.time(), "latencies": latencies})],
+            RELATION_LOAD_MAX_SIZE,
+            RELATION_LOAD_KEEP,
+        )
+        return summary
+
+    def __run_relation_load(self, load: Dict[str, Any], reason: str):
+        try:
+            summary = self.generate_relation_load(**load)
+            logger.info("relation load %s: %s", reason, summary)
+        except Exception:
+            logger.exception("error while generating relation load %s", reason)
+
+    def _on_relation_load_trigger_(self, event):
+        if self.config.get("relation-load"):
+            self.__run_relation_load(json.loads(self.config["relation-load"]), "configured")
+
+    def _get_relation_data_(self, event: ops.ActionEvent):
+        try:
+            relations = self.__select_relations(event.params)
+            limit = event.params["limit"]
+            results = {}
+            if limit and len(relations) > limit:
+                relations = relations[:limit]
+                results["next-cursor"] = str(relations[-1].id)
+            relation_data_list = [
+                self.__extrack_relation_data(relation, event.params) for relation in relations
+            ]
+            results.update(
+                _encode_result(
+                    "relation-data",
+                    json.dumps(relation_data_list),
+                    event.params["result-encoding"],
+                )
+            )
+            if event.params["resolve-secrets"]:
+                references = self.__secret_references(relation_data_list)
+                uncached = [secret_id for secret_id, local in references.items() if local]
+                secrets_json = json.dumps(self.resolve_secrets(list(references), uncached))
+                results.update(
+                    _encode_result("secrets", secrets_json, event.params["result-encoding"])
+                )
+            event.set_results(results)
         except Exception as exc:
             logger.exception("error while handling get-relation-data action")
             event.fail(repr(exc))
+        finally:
+            self.__log_hook_tool_calls("get-relation-data")
+
+    def __rpc_stream(
+        self,
+        method: str,
+        items: typing.Iterator[Any],
+        writer: _ResultWriter,
+        deadline: Optional[float],
+        event: ops.ActionEvent,
+    ) -> str:
+        """Write the items of a generator method as a JSON list while iterating it.
+
+        The list is closed even if the generator fails or the deadline passes, so the items
+        written so far stay a valid partial result.
+        """
+        writer.write("[")
+        count = 0
+        progress_time = time.monotonic()
+        try:
+            for item in items:
+                item_json = json.dumps(item)
+                writer.write(f", {item_json}" if count else item_json)
+                count += 1
+                if time.monotonic() - progress_time >= RPC_PROGRESS_INTERVAL:
+                    progress_time = time.monotonic()
+                    preview = item_json[:RPC_PROGRESS_PREVIEW_SIZE]
+                    event.log(f"{method}: {count} items, latest {preview}")
+                _remaining(deadline)
+        except _RpcDeadlineExceeded:
+            event.log(f"{method}: deadline exceeded after {count} items")
+            return RPC_STATUS_DEADLINE_EXCEEDED
+        finally:
+            if isinstance(items, collections.abc.Generator):
+                items.close()
+            writer.write("]")
+        return RPC_STATUS_COMPLETE
+
+    def __rpc_invoke(
+        self,
+        call: Dict[str, Any],
+        writer: _ResultWriter,
+        deadline: Optional[float],
+        event: ops.ActionEvent,
+        prefix: str = "",
+    ) -> str:
+        """Invoke a rpc method, write its JSON encoded return value and get the status.
+
+        Generator and async generator methods are streamed as a JSON list, coroutine methods
+        are awaited. Nothing is written if the method fails before returning or yielding.
+        """
+        method = call["method"]
+        result = getattr(self, method)(*call.get("args", []), **call.get("kwargs", {}))
+        if isinstance(result, collections.abc.AsyncGenerator):
+            result = _iterate_async(result, deadline)
+        elif isinstance(result, collections.abc.Generator):
+            pass
+        elif isinstance(result, collections.abc.Coroutine):
+            try:
+                result = _await(result, deadline)
+            except _RpcDeadlineExceeded:
+                writer.write(f"{prefix}null")
+                return RPC_STATUS_DEADLINE_EXCEEDED
+        if isinstance(result, collections.abc.Generator):
+            writer.write(prefix)
+            return self.__rpc_stream(method, result, writer, deadline, event)
+        writer.write(f"{prefix}{json.dumps(result)}")
+        return RPC_STATUS_COMPLETE
+
+    def __rpc_batch(
+        self,
+        calls: List[Dict[str, Any]],
+        stop_on_error: bool,
+        writer: _ResultWriter,
+        deadline: Optional[float],
+        event: ops.ActionEvent,
+    ) -> str:
+        writer.write("[")
+        status = RPC_STATUS_COMPLETE
+        for idx, call in enumerate(calls):
+            if deadline is not None and time.monotonic() >= deadline:
+                status = RPC_STATUS_DEADLINE_EXCEEDED
+                break
+            separator = ", " if idx else ""
+            written = writer.written
+            try:
+                status = self.__rpc_invoke(
+                    call, writer, deadline, event, f'{separator}{{"return": '
+                )
+                writer.write("}" if status == RPC_STATUS_COMPLETE else f', "status": "{status}"}}')
+                if status != RPC_STATUS_COMPLETE:
+                    break
+            except Exception as exc:
+                logger.exception("error while invoking %s in rpc batch", call.get("method"))
+                if writer.written == written:
+                    writer.write(f"{separator}{json.dumps({'error': repr(exc)})}")
+                else:
+                    # a partial result has been streamed already
+                    writer.write(f', "error": {json.dumps(repr(exc))}}}')
+                if stop_on_error:
+                    break
+        writer.write("]")
+        return status
 
     def _rpc_(self, event: ops.ActionEvent):
+        writer = None
         try:
             action_params = event.params
-            method = action_params["method"]
-            args = json.loads(action_params["args"])
-            kwargs = json.loads(action_params["kwargs"])
-            result = getattr(self, method)(*args, **kwargs)
-            event.set_results({"return": json.dumps(result)})
+            deadline = None
+            if action_params.get("deadline"):
+                deadline = time.monotonic() + action_params["deadline"]
+            writer = _ResultWriter("return", action_params["result-encoding"])
+            if "calls" in action_params:
+                calls = json.loads(action_params["calls"])
+                status = self.__rpc_batch(
+                    calls, action_params["stop-on-error"], writer, deadline, event
+                )
+            else:
+                call = {
+                    "method": action_params["method"],
+                    "args": json.loads(action_params["args"]),
+                    "kwargs": json.loads(action_params["kwargs"]),
+                }
+                status = self.__rpc_invoke(call, writer, deadline, event)
+            event.set_results({"return-status": status, **writer.results()})
         except Exception as exc:
             logger.exception("error while handling rpc action")
             event.fail(repr(exc))
+        finally:
+            if writer is not None:
+                writer.close()
+            self.__log_hook_tool_calls("rpc")
+
+    def _get_hook_stats_(self, event: ops.ActionEvent):
+        try:
+            stats_path = self.charm_dir / HOOK_STATS_FILENAME
+            records = []
+            if stats_path.exists():
+                records = [json.loads(line) for line in stats_path.read_text().splitlines()]
+            if event.params.get("event"):
+                records = [
+                    record for record in records if record["event"] == event.params["event"]
+                ]
+            profiles = sorted(str(p) for p in (self.charm_dir / PROFILE_DIRNAME).glob("*.pstats"))
+            event.set_results(
+                {
+                    "hook-stats": json.dumps(_aggregate_hook_stats(records)),
+                    "profiles": json.dumps(profiles),
+                }
+            )
+        except Exception as exc:
+            logger.exception("error while handling get-hook-stats action")
+            event.fail(repr(exc))
+
+    def _profile_hooks_(self, event: ops.ActionEvent):
+        try:
+            request = {"event": event.params["event"], "count": event.params["count"]}
+            (self.charm_dir / PROFILE_REQUEST_FILENAME).write_text(json.dumps(request))
+            event.set_results({"profile-dir": str(self.charm_dir / PROFILE_DIRNAME)})
+        except Exception as exc:
+            logger.exception("error while handling profile-hooks action")
+            event.fail(repr(exc))
+
+    def _get_relation_changes_(self, event: ops.ActionEvent):
+        try:
+            changes_path = self.charm_dir / RELATION_CHANGES_FILENAME
+            records = []
+            if changes_path.exists():
+                records = [
+                    json.loads(line)
+                    for line in changes_path.read_text(encoding="utf-8").splitlines()
+                ]
+            cursor = int(event.params["cursor"] or 0)
+            # the changes between the cursor and the oldest record have been compacted away
+            truncated = bool(records) and records[0]["seq"] > cursor + 1
+            changes = [record for record in records if record["seq"] > cursor]
+            results = {
+                "cursor": str(records[-1]["seq"] if records else cursor),
+                "truncated": str(truncated).lower(),
+            }
+            results.update(
+                _encode_result(
+                    "relation-changes", json.dumps(changes), event.params["result-encoding"]
+                )
+            )
+            event.set_results(results)
+        except Exception as exc:
+            logger.exception("error while handling get-relation-changes action")
+            event.fail(repr(exc))
+
+    def _relation_load_(self, event: ops.ActionEvent):
+        try:
+            params = event.params
+            results = {}
+            if params["iterations"]:
+                summary = self.generate_relation_load(
+                    keys=params["keys"],
+                    value_size=params["value-size"],
+                    iterations=params["iterations"],
+                    rate=params["rate"],
+                    endpoints=json.loads(params["endpoints"]) or None,
+                    app=params["app"],
+                    peers=params["peers"],
+                )
+                results["load"] = json.dumps(summary)
+            load_path = self.charm_dir / RELATION_LOAD_FILENAME
+            latencies = []
+            if load_path.exists():
+                for line in load_path.read_text(encoding="utf-8").splitlines():
+                    latencies.extend(json.loads(line)["latencies"])
+            results["latency"] = json.dumps(_percentiles(latencies) if latencies else None)
+            event.set_results(results)
+        except Exception as exc:
+            logger.exception("error while handling relation-load action")
+            event.fail(repr(exc))
+        finally:
+            self.__log_hook_tool_calls("relation-load")
+
+    def _reset_(self, event: ops.ActionEvent):
+        try:
+            report_path = self.charm_dir / RESET_REPORT_FILENAME
+            report = {"src": {"written": 0, "removed": []}, "dynamic-packages": False}
+            if report_path.exists():
+                report = json.loads(report_path.read_text(encoding="utf-8"))
+                report_path.unlink()
+            changes = self.reset_relation_data()
+            # the recorded relation changes, loads and secrets belong to the previous user
+            cleared = []
+            for filename in (
+                RELATION_CHANGES_FILENAME,
+                RELATION_SNAPSHOT_FILENAME,
+                RELATION_LOAD_FILENAME,
+                SECRET_CACHE_FILENAME,
+            ):
+                path = self.charm_dir / filename
+                if path.exists():
+                    path.unlink()
+                    cleared.append(filename)
+            event.set_results(
+                {
+                    "src": json.dumps(report["src"]),
+                    "dynamic-packages": "reset" if report["dynamic-packages"] else "unchanged",
+                    "relation-data": json.dumps(changes),
+                    "cleared": json.dumps(cleared),
+                }
+            )
+        except Exception as exc:
+            logger.exception("error while handling reset action")
+            event.fail(repr(exc))
+        finally:
+            self.__log_hook_tool_calls("reset")
@@ -2,157 +2,1033 @@
 # Copyright 2024 Canonical Ltd.
 # See LICENSE file for licensing details.
 
-"""any-charm entrypoint."""
+"""any-charm entrypoint.
 
-import ast
+Most hooks run with an unchanged config and only need ops, so modules used to apply the config
+are imported inside the functions using them to keep the charm startup time low.
+"""
+
+from __future__ import annotations
+
+import contextlib
+import functools
+import hashlib
+import json
 import os
 import pathlib
-import shutil
 import subprocess
 import sys
+import time
+import typing
+import zlib
 
-import yaml
-from charmhelpers.core import hookenv
 from ops.main import main
-from packaging.requirements import Requirement
-from packaging.version import Version
+
+from file_utils import append_bounded_log, file_digest, write_file_atomic
+
+if typing.TYPE_CHECKING:
+    import email.message
+
+    from packaging.requirements import Requirement
+    from packaging.version import Version
 
 SRC_DIR = pathlib.Path(os.path.abspath(os.path.split(__file__)[0]))
 CHARM_DIR = SRC_DIR.parent
 THIS_FILE = pathlib.Path(__file__)
-WHEELHOUSE_PACKAGES = [
-    (line.split("==")[0], Version(line.split("==")[1]))
-    for line in (CHARM_DIR / "wheelhouse.txt").read_text().splitlines()
-]
 WHEELHOUSE_DIR = CHARM_DIR / "wheelhouse"
+WHEELHOUSE_INDEX_FILENAME = "index.json"
 DYNAMIC_PACKAGES_PATH = CHARM_DIR / "dynamic-packages"
+# package environments are shared by all any-charm units in the same machine or container, in
+# a charm-owned directory outside of the Juju agents directory, the environment variable lets
+# the offline benchmarks use a private store
+PACKAGE_STORE_DIR = pathlib.Path(
+    os.environ.get("ANY_CHARM_PACKAGE_STORE", "/var/lib/any-charm/package-store")
+)
+PACKAGE_STORE_MAX_SIZE = 1024 * 1024 * 1024
+STATE_PATH = CHARM_DIR / ".any-charm-state"
+STATE_VERSION = 1
+HOOK_STATS_PATH = CHARM_DIR / ".any-charm-hook-stats"
+HOOK_STATS_MAX_SIZE = 1024 * 1024
+HOOK_STATS_KEEP = 1000
+PROFILE_REQUEST_PATH = CHARM_DIR / ".any-charm-profile-request"
+PROFILE_DIR = CHARM_DIR / ".any-charm-profiles"
+SRC_OVERWRITE_ARCHIVE_HEADER = "any-charm-archive/v1"
+RESOURCE_NAME = "overwrite"
+RESOURCE_DIR = CHARM_DIR / ".any-charm-resource"
+RESOURCE_SRC_DIR = RESOURCE_DIR / "src"
+RESOURCE_WHEELS_DIR = RESOURCE_DIR / "wheels"
+RESOURCE_REQUIREMENTS_PATH = RESOURCE_DIR / "requirements.txt"
+RPC_SERVER_SCRIPT = "rpc_server.py"
+RPC_SERVER_STATE_PATH = CHARM_DIR / ".any-charm-rpc-server"
+RPC_SERVER_LOG_PATH = CHARM_DIR / ".any-charm-rpc-server.log"
+RPC_SERVER_STOP_TIMEOUT = 5
+# the reset action dispatch applies the default src-overwrite and python-packages
+RESET_CONFIG = {"src-overwrite": "{}", "python-packages": ""}
+RESET_REPORT_PATH = CHARM_DIR / ".any-charm-reset"
 
-original = {}
-installed_python_packages = ""
-
-
-def self_modify_assign_value(symbol: str, value_repr: str):
-    """Search the source code for an assign statement and update its right value in the code."""
-    source = THIS_FILE.read_text(encoding="utf-8")
-    root = ast.parse(source)
-    source_lines = source.splitlines(keepends=True)
-    for stmt in ast.iter_child_nodes(root):
-        if not (
-            isinstance(stmt, ast.Assign)
-            and len(stmt.targets) == 1
-            and isinstance(stmt.targets[0], ast.Name)
-            and stmt.targets[0].id == symbol
-        ):
-            continue
-        value = stmt.value
-        start_offset = (
-            sum(len(line) for line in source_lines[: value.lineno - 1]) + value.col_offset
+phase_timings: typing.Dict[str, float] = {}
+# hook tools called by the entrypoint itself, the AnyCharm counts its own calls
+hook_tool_calls: typing.Dict[str, int] = {}
+
+
+def count_hook_tool_call(tool: str):
+    """Count a hook tool call of the entrypoint into hook_tool_calls."""
+    hook_tool_calls[tool] = hook_tool_calls.get(tool, 0) + 1
+
+
+def juju_log(message: str, level: str = "INFO"):
+    """Write a message to the Juju debug log, or to stderr outside of Juju hooks."""
+    count_hook_tool_call("juju-log")
+    try:
+        subprocess.run(["juju-log", "-l", level, message], check=False)
+    except OSError:
+        print(f"juju-log: {message}", file=sys.stderr)
+
+
+@contextlib.contextmanager
+def timed_phase(name: str):
+    """Measure the wall time of a dispatch phase into phase_timings."""
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        phase_timings[name] = phase_timings.get(name, 0.0) + time.monotonic() - start
+
+
+def text_digest(text: str) -> str:
+    """Calculate the sha256 hex digest of a text."""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+@functools.lru_cache(maxsize=None)
+def charm_config() -> dict:
+    """Read the charm configuration, at most once per hook."""
+    count_hook_tool_call("config-get")
+    return json.loads(subprocess.check_output(["config-get", "--all", "--format=json"]))
+
+
+def src_overwrite_archive_digest(src_overwrite: str) -> typing.Optional[str]:
+    """Get the content hash in the header of a src-overwrite archive, None for a file map."""
+    if not src_overwrite.startswith(SRC_OVERWRITE_ARCHIVE_HEADER):
+        return None
+    header = src_overwrite.partition("\n")[0]
+    fields = [field.partition("=") for field in header.split()[1:]]
+    digest = {key: value for key, separator, value in fields if separator}.get("sha256")
+    if digest is None or not all(separator for _, separator, _ in fields):
+        raise ValueError(
+            f"invalid src-overwrite archive header {header!r}, "
+            f"expected '{SRC_OVERWRITE_ARCHIVE_HEADER} sha256=<hex digest>'"
         )
-        end_offset = (
-            sum(len(line) for line in source_lines[: value.end_lineno - 1]) + value.end_col_offset
+    return digest
+
+
+def config_fingerprint(config: typing.Optional[dict] = None) -> str:
+    """Calculate the fingerprint of the configuration applied by the charm.py prelude."""
+    config = charm_config() if config is None else config
+    src_overwrite = config["src-overwrite"]
+    if src_overwrite_archive_digest(src_overwrite) is not None:
+        # the header hashes the archive already
+        src_overwrite = src_overwrite.partition("\n")[0]
+    applied = [src_overwrite, config["python-packages"]]
+    if state.resource:
+        applied.append(state.resource)
+    return text_digest(json.dumps(applied))
+
+
+class PreludeState:
+    """State of the charm.py prelude, persisted next to the charm directory.
+
+    The state holds the pristine src file contents, the digest of the installed python-packages,
+    the manifest of the materialised src files, the hash of the applied src-overwrite archive,
+    the hash of the unpacked overwrite resource and the fingerprint of the applied config. It's
+    stored as zlib compressed JSON, loaded on first access and rewritten atomically on update.
+    """
+
+    _DEFAULTS = {
+        "original": {},
+        "packages": text_digest(""),
+        "manifest": {},
+        "archive": "",
+        "resource": "",
+        "fingerprint": "",
+    }
+
+    def __init__(self, path: pathlib.Path = STATE_PATH):
+        self._path = path
+        self._data = None
+
+    def __getattr__(self, name):
+        """Get a state value, loading the state file on first access."""
+        if name not in self._DEFAULTS:
+            raise AttributeError(name)
+        return self._load().get(name, self._DEFAULTS[name])
+
+    def _load(self) -> dict:
+        if self._data is None:
+            self._data = self._read()
+        return self._data
+
+    def _read(self) -> dict:
+        charm_digest = hashlib.sha256(THIS_FILE.read_bytes()).hexdigest()
+        try:
+            data = json.loads(zlib.decompress(self._path.read_bytes()))
+        except FileNotFoundError:
+            # also the case after upgrading from revisions that kept the state in charm.py, which
+            # has been replaced, the upgraded pristine src files are snapshotted again
+            return {"version": STATE_VERSION, "charm": charm_digest}
+        except (zlib.error, ValueError):
+            juju_log(f"discarding unreadable state file {self._path}", level="WARNING")
+            data = {}
+        if data.get("version") != STATE_VERSION:
+            return {"version": STATE_VERSION, "charm": charm_digest}
+        if data.get("charm") != charm_digest:
+            data = self._upgraded(data, charm_digest)
+        return data
+
+    def _upgraded(self, data: dict, charm_digest: str) -> dict:
+        """Reset the state after a charm upgrade.
+
+        The src directory has been replaced with the new pristine files, only files created
+        solely by src-overwrite are still around.
+        """
+        original = data.get("original", {})
+        manifest = data.get("manifest", {})
+        return {
+            "version": STATE_VERSION,
+            "charm": charm_digest,
+            "packages": data.get("packages", self._DEFAULTS["packages"]),
+            "manifest": {f: d for f, d in manifest.items() if f not in original},
+        }
+
+    def check_upgrade(self):
+        """Reset the state if a charm upgrade has replaced any pristine src file.
+
+        Every hook only compares the charm.py, in the upgrade-charm hook the other pristine src
+        files are compared with their snapshot too, or with the manifest if they have been
+        overwritten. A retried hook finds the state matching the src files already.
+        """
+        data = self._load()
+        original = data.get("original", {})
+        manifest = data.get("manifest", {})
+        expected = {
+            filename: manifest.get(filename) or text_digest(content)
+            for filename, content in original.items()
+        }
+        current = {
+            f.name: text_digest(f.read_text(encoding="utf-8"))
+            for f in SRC_DIR.iterdir()
+            if f.name.endswith(".py")
+            and not f.samefile(THIS_FILE)
+            and (f.name in original or f.name not in manifest)
+        }
+        if original and current != expected:
+            juju_log("pristine src files changed by the charm upgrade, resetting the state")
+            self._data = self._upgraded(data, data["charm"])
+
+    def update(self, **values):
+        """Update state values and persist the state."""
+        for name in values:
+            if name not in self._DEFAULTS:
+                raise KeyError(name)
+        data = {**self._load(), **values}
+        write_file_atomic(
+            self._path, zlib.compress(json.dumps(data, separators=(",", ":")).encode("utf-8"))
         )
-        new_source = source[:start_offset]
-        new_source += value_repr
-        new_source += source[end_offset:]
-        THIS_FILE.write_text(new_source, encoding="utf-8")
-        break
-    else:
-        raise RuntimeError(f"failed to modifying {symbol} value in source code")
+        self._data = data
+
+
+state = PreludeState()
+
+
+def pip_install(requirements: str, target: pathlib.Path):
+    """Install Python dependencies listed in requirements into the target directory.
 
+    Requirements whose dependency closure can be fully resolved against the wheelhouse are
+    installed offline from the wheelhouse, the others are installed from PyPI.
+    """
+    from packaging.requirements import Requirement
 
-def pip_install(requirements: str):
-    """Install Python dependencies listed in requirements."""
     install_wheelhouse = []
     install_pypi = []
     for line in requirements.splitlines():
         if not line.strip():
             continue
         req = Requirement(line)
-        if req.url is not None:
-            install_pypi.append(line)
+        if not requirement_applies(req):
+            juju_log(f"skipping python package {line}, its environment marker doesn't match")
             continue
-        if req.extras:
-            install_pypi.append(line)
-            continue
-        for name, version in WHEELHOUSE_PACKAGES:
-            if name == req.name and version in req.specifier:
-                install_wheelhouse.append(line)
-                break
-        else:
+        try:
+            resolve_wheels([req])
+            install_wheelhouse.append(line)
+        except WheelResolutionError:
             install_pypi.append(line)
     if install_wheelhouse:
-        hookenv.log(f"installing python packages {install_wheelhouse} from wheelhouse")
-        subprocess.check_call(
-            [
-                sys.executable,
-                "-m",
-                "pip",
-                "install",
-                "--root-user-action=ignore",
-                f"--target={DYNAMIC_PACKAGES_PATH}",
-                "--no-index",
-                f"--find-links={WHEELHOUSE_DIR}",
-                *install_wheelhouse,
-            ]
-        )
+        install_from_wheelhouse(install_wheelhouse, target)
     if install_pypi:
-        hookenv.log(f"installing python packages {install_pypi} from pypi")
-        subprocess.check_call(
-            [
-                sys.executable,
-                "-m",
-                "pip",
-                "install",
-                "--root-user-action=ignore",
-                f"--target={DYNAMIC_PACKAGES_PATH}",
-                *install_pypi,
-            ]
+        juju_log(f"installing python packages {install_pypi} from pypi")
+        start = time.monotonic()
+        pip_subprocess_install(install_pypi, target, *find_links_args())
+        juju_log(f"installed python packages from pypi in {time.monotonic() - start:.3f}s")
+
+
+def pip_subprocess_install(requirements: typing.List[str], target: pathlib.Path, *pip_args: str):
+    """Install requirements into the target directory with a pip subprocess."""
+    subprocess.check_call(
+        [
+            sys.executable,
+            "-m",
+            "pip",
+            "install",
+            "--root-user-action=ignore",
+            f"--target={target}",
+            *pip_args,
+            *requirements,
+        ]
+    )
+
+
+class WheelResolutionError(Exception):
+    """Requirements can't be satisfied with the wheels in the wheelhouse alone."""
+
+
+class WheelhouseWheel(typing.NamedTuple):
+    """A wheel in the wheelhouse."""
+
+    version: Version
+    path: pathlib.Path
+    requires_dist: typing.Tuple[str, ...]
+
+
+def wheel_metadata(wheel: pathlib.Path) -> email.message.Message:
+    """Read the core metadata of a wheel."""
+    import email.parser
+    import zipfile
+
+    with zipfile.ZipFile(wheel) as wheel_zip:
+        metadata_file = next(
+            name
+            for name in wheel_zip.namelist()
+            if name.count("/") == 1 and name.endswith(".dist-info/METADATA")
+        )
+        return email.parser.BytesParser().parsebytes(
+            wheel_zip.read(metadata_file), headersonly=True
         )
 
 
+def wheelhouse_dirs() -> typing.List[pathlib.Path]:
+    """Get the directories of the wheels available offline."""
+    return [WHEELHOUSE_DIR, *([RESOURCE_WHEELS_DIR] if RESOURCE_WHEELS_DIR.is_dir() else [])]
+
+
+def find_links_args() -> typing.List[str]:
+    """Get the pip arguments to look up the wheels available offline."""
+    return [f"--find-links={wheelhouse}" for wheelhouse in wheelhouse_dirs()]
+
+
+@functools.lru_cache(maxsize=None)
+def wheelhouse_index(wheelhouse: pathlib.Path) -> typing.List[dict]:
+    """Load the wheelhouse index built at charm build time, or index the wheels if it's absent."""
+    from packaging.utils import parse_wheel_filename
+
+    try:
+        index_text = (wheelhouse / WHEELHOUSE_INDEX_FILENAME).read_text(encoding="utf-8")
+        return json.loads(index_text)["wheels"]
+    except FileNotFoundError:
+        pass
+    index = []
+    for wheel in wheelhouse.glob("*.whl"):
+        name, version, _, tags = parse_wheel_filename(wheel.name)
+        index.append(
+            {
+                "name": name,
+                "version": str(version),
+                "filename": wheel.name,
+                "tags": [str(tag) for tag in tags],
+                "requires_dist": wheel_metadata(wheel).get_all("Requires-Dist") or [],
+            }
+        )
+    return index
+
+
+@functools.lru_cache(maxsize=None)
+def wheelhouse_wheels() -> typing.Dict[str, typing.List[WheelhouseWheel]]:
+    """Index the offline wheels compatible with the running Python by name, newest first."""
+    from packaging.tags import sys_tags
+    from packaging.utils import canonicalize_name
+    from packaging.version import Version
+
+    supported_tags = {str(tag) for tag in sys_tags()}
+    wheels: typing.Dict[str, typing.List[WheelhouseWheel]] = {}
+    for wheelhouse in wheelhouse_dirs():
+        for entry in wheelhouse_index(wheelhouse):
+            if supported_tags.isdisjoint(entry["tags"]):
+                continue
+            wheels.setdefault(canonicalize_name(entry["name"]), []).append(
+                WheelhouseWheel(
+                    version=Version(entry["version"]),
+                    path=wheelhouse / entry["filename"],
+                    requires_dist=tuple(entry["requires_dist"]),
+                )
+            )
+    for candidates in wheels.values():
+        candidates.sort(key=lambda wheel: wheel.version, reverse=True)
+    return wheels
+
+
+def requirement_applies(req: Requirement) -> bool:
+    """Check if the environment marker of a top-level requirement matches the running Python."""
+    return req.marker is None or req.marker.evaluate()
+
+
+def wheel_requirements(
+    wheel: WheelhouseWheel, extras: typing.Iterable[str]
+) -> typing.List[Requirement]:
+    """Get the dependencies of a wheel with the extras that apply to the running environment."""
+    from packaging.requirements import Requirement
+
+    environments = [{"extra": extra} for extra in ("", *extras)]
+    requirements = []
+    for line in wheel.requires_dist:
+        req = Requirement(line)
+        if req.marker is None or any(req.marker.evaluate(env) for env in environments):
+            requirements.append(req)
+    return requirements
+
+
+def resolve_wheels(requirements: typing.List[Requirement]) -> typing.List[pathlib.Path]:
+    """Resolve the requirements and their dependency closure to wheels in the wheelhouse."""
+    from packaging.specifiers import SpecifierSet
+    from packaging.utils import canonicalize_name
+
+    wheels = wheelhouse_wheels()
+    specifiers: typing.Dict[str, SpecifierSet] = {}
+    selected: typing.Dict[str, WheelhouseWheel] = {}
+    selected_extras: typing.Dict[str, typing.Set[str]] = {}
+    pending = list(requirements)
+    while pending:
+        req = pending.pop()
+        if req.url is not None:
+            raise WheelResolutionError(f"wheelhouse can't satisfy {req}")
+        name = canonicalize_name(req.name)
+        specifiers[name] = specifiers.get(name, SpecifierSet()) & req.specifier
+        if name not in selected:
+            wheel = next(
+                (wheel for wheel in wheels.get(name, []) if wheel.version in specifiers[name]),
+                None,
+            )
+            if wheel is None:
+                raise WheelResolutionError(f"no wheel in wheelhouse matches {req}")
+            selected[name] = wheel
+            selected_extras[name] = set()
+            pending.extend(wheel_requirements(wheel, ()))
+        elif selected[name].version not in specifiers[name]:
+            raise WheelResolutionError(f"conflicting requirements for {name} in wheelhouse")
+        new_extras = req.extras - selected_extras[name]
+        if new_extras:
+            selected_extras[name] |= new_extras
+            pending.extend(wheel_requirements(selected[name], new_extras))
+    return [wheel.path for wheel in selected.values()]
+
+
+def wheel_member_path(filename: str) -> typing.Optional[typing.List[str]]:
+    """Get the path parts relative to the install target of a wheel member."""
+    parts = filename.split("/")
+    if not parts[0].endswith(".data"):
+        return parts
+    if len(parts) > 2 and parts[1] in ("purelib", "platlib"):
+        return parts[2:]
+    if len(parts) > 2 and parts[1] == "scripts":
+        return ["bin", *parts[2:]]
+    return None
+
+
+def install_wheel(wheel: pathlib.Path, target: pathlib.Path):
+    """Unpack a wheel into the target directory, the same way as pip install --target."""
+    import shutil
+    import zipfile
+
+    with zipfile.ZipFile(wheel) as wheel_zip:
+        for member in wheel_zip.infolist():
+            path_parts = None if member.is_dir() else wheel_member_path(member.filename)
+            if path_parts is None:
+                continue
+            path = target.joinpath(*path_parts)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with wheel_zip.open(member) as src, open(path, "wb") as dst:
+                shutil.copyfileobj(src, dst)
+            if (member.external_attr >> 16) & 0o111:
+                path.chmod(0o755)
+
+
+def install_from_wheelhouse(requirements: typing.List[str], target: pathlib.Path):
+    """Install requirements into the target directory from the wheelhouse.
+
+    Wheels are unpacked in-process and in parallel if all the requirements and their
+    dependencies can be satisfied by the wheelhouse, pip is used otherwise.
+    """
+    import concurrent.futures
+
+    from packaging.requirements import Requirement
+
+    juju_log(f"installing python packages {requirements} from wheelhouse")
+    start = time.monotonic()
+    try:
+        wheels = resolve_wheels(
+            [req for req in map(Requirement, requirements) if requirement_applies(req)]
+        )
+    except WheelResolutionError as exc:
+        juju_log(f"{exc}, installing python packages {requirements} with pip")
+        pip_subprocess_install(requirements, target, "--no-index", *find_links_args())
+    else:
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            for future in [executor.submit(install_wheel, wheel, target) for wheel in wheels]:
+                future.result()
+    juju_log(f"installed python packages from wheelhouse in {time.monotonic() - start:.3f}s")
+
+
 def preserve_original():
     """Save the original src file contents."""
-    global original
-    if not original:
-        original = {
-            str(f.relative_to(SRC_DIR)): f.read_text(encoding="utf-8")
-            for f in SRC_DIR.iterdir()
-            if f.name.endswith(".py") and not f.samefile(THIS_FILE)
-        }
-        self_modify_assign_value(f"{original=}".split("=")[0], repr(original))
-
-
-def install_packages():
-    """Install required Python packages."""
-    python_packages = hookenv.config("python-packages")
-    if python_packages != installed_python_packages:
-        shutil.rmtree(DYNAMIC_PACKAGES_PATH, ignore_errors=True)
-        os.mkdir(DYNAMIC_PACKAGES_PATH)
-        pip_install(python_packages)
-        self_modify_assign_value(
-            f"{installed_python_packages=}".split("=")[0], repr(python_packages)
+    if not state.original:
+        state.update(
+            original={
+                str(f.relative_to(SRC_DIR)): f.read_text(encoding="utf-8")
+                for f in SRC_DIR.iterdir()
+                if f.name.endswith(".py")
+                and not f.samefile(THIS_FILE)
+                and str(f.relative_to(SRC_DIR)) not in state.manifest
+            }
         )
 
 
-def src_overwrite():
-    """Update the src file contents based on the charm configuration."""
-    for src_overwrite_filename, src_overwrite_file_content in {
-        **original,
-        **yaml.safe_load(hookenv.config("src-overwrite")),
+def compile_bytecode(directory: pathlib.Path, description: str):
+    """Compile the Python files in a directory to bytecode in parallel.
+
+    Checked hash-based pycs are used, so rewriting a file with the same content doesn't
+    invalidate its bytecode.
+    """
+    import compileall
+    import py_compile
+
+    start = time.monotonic()
+    compileall.compile_dir(
+        directory,
+        quiet=1,
+        workers=0,
+        invalidation_mode=py_compile.PycInvalidationMode.CHECKED_HASH,
+    )
+    juju_log(f"compiled {description} bytecode in {time.monotonic() - start:.3f}s")
+
+
+def requirements_key(requirements: str) -> str:
+    """Calculate the package store key of the requirements for the running Python ABI."""
+    import platform
+
+    from packaging.requirements import Requirement
+
+    normalised = sorted(
+        str(Requirement(line)) for line in requirements.splitlines() if line.strip()
+    )
+    abi = f"{sys.implementation.cache_tag}-{platform.machine()}"
+    # the environment also holds the requirements of the overwrite resource
+    resource = [state.resource] if state.resource else []
+    return text_digest(json.dumps([abi, normalised, *resource]))
+
+
+def share_package_files(env: pathlib.Path):
+    """Replace files in a package environment with hardlinks to identical files in the store."""
+    objects = PACKAGE_STORE_DIR / "objects"
+    objects.mkdir(parents=True, exist_ok=True)
+    for path in env.rglob("*"):
+        if path.is_symlink() or not path.is_file():
+            continue
+        executable = "-x" if os.access(path, os.X_OK) else ""
+        shared_path = objects / f"{file_digest(path)}{executable}"
+        if shared_path.exists():
+            link_path = path.with_name(f".{path.name}.link")
+            os.link(shared_path, link_path)
+            os.replace(link_path, path)
+        else:
+            os.link(path, shared_path)
+
+
+def package_store_size() -> int:
+    """Calculate the size of the unique files in the package store."""
+    objects = PACKAGE_STORE_DIR / "objects"
+    return sum(f.stat().st_size for f in objects.iterdir()) if objects.is_dir() else 0
+
+
+def package_store_references() -> typing.Set[str]:
+    """Get the package environments in use by any-charm units that still exist."""
+    references = set()
+    for reference in (PACKAGE_STORE_DIR / "refs").iterdir():
+        charm_dir, env_key = json.loads(reference.read_text(encoding="utf-8"))
+        if pathlib.Path(charm_dir).is_dir():
+            references.add(env_key)
+        else:
+            reference.unlink()
+    return references
+
+
+def evict_package_envs():
+    """Remove least recently used package environments while the store exceeds its size cap."""
+    import shutil
+
+    references = package_store_references()
+    envs = sorted(
+        (env for env in (PACKAGE_STORE_DIR / "envs").iterdir() if not env.name.startswith(".")),
+        key=lambda env: env.stat().st_mtime,
+    )
+    for env in envs:
+        if package_store_size() <= PACKAGE_STORE_MAX_SIZE:
+            return
+        if env.name in references:
+            continue
+        juju_log(f"evicting python packages environment {env.name} from package store")
+        shutil.rmtree(env)
+        for shared_path in (PACKAGE_STORE_DIR / "objects").iterdir():
+            if shared_path.stat().st_nlink == 1:
+                shared_path.unlink()
+
+
+def package_env(requirements: str) -> pathlib.Path:
+    """Get the package store environment for the requirements, installing it if absent."""
+    import shutil
+
+    env = PACKAGE_STORE_DIR / "envs" / requirements_key(requirements)
+    if not env.is_dir():
+        tmp_env = env.with_name(f".{env.name}.tmp")
+        shutil.rmtree(tmp_env, ignore_errors=True)
+        tmp_env.mkdir(parents=True)
+        offline_requirements = resource_requirements()
+        if offline_requirements:
+            install_from_wheelhouse(offline_requirements, tmp_env)
+        pip_install(requirements, tmp_env)
+        compile_bytecode(tmp_env, "python packages")
+        share_package_files(tmp_env)
+        os.replace(tmp_env, env)
+    else:
+        juju_log(f"using python packages environment {env.name} from package store")
+    os.utime(env)
+    return env
+
+
+def switch_dynamic_packages(env: pathlib.Path):
+    """Atomically point the dynamic-packages directory to a package environment."""
+    import shutil
+
+    link = DYNAMIC_PACKAGES_PATH.with_name(f".{DYNAMIC_PACKAGES_PATH.name}.tmp")
+    link.unlink(missing_ok=True)
+    link.symlink_to(env, target_is_directory=True)
+    if DYNAMIC_PACKAGES_PATH.is_dir() and not DYNAMIC_PACKAGES_PATH.is_symlink():
+        shutil.rmtree(DYNAMIC_PACKAGES_PATH)
+    os.replace(link, DYNAMIC_PACKAGES_PATH)
+    reference = PACKAGE_STORE_DIR / "refs" / text_digest(str(CHARM_DIR))
+    reference.parent.mkdir(parents=True, exist_ok=True)
+    write_file_atomic(reference, json.dumps([str(CHARM_DIR), env.name]).encode("utf-8"))
+
+
+def dynamic_packages_available() -> bool:
+    """Check that dynamic-packages doesn't point to a missing package environment.
+
+    The package store lives outside of the charm directory and can be wiped independently of
+    the state file, like by a restart of the any-charm-k8s charm container. Without
+    python-packages no environment may have been installed and dynamic-packages is absent.
+    """
+    return not DYNAMIC_PACKAGES_PATH.is_symlink() or DYNAMIC_PACKAGES_PATH.resolve().is_dir()
+
+
+def install_packages(config: typing.Optional[dict] = None):
+    """Install required Python packages.
+
+    Installed packages are kept in a content-addressed store keyed by the requirements, so
+    switching back to previously installed requirements only swaps the dynamic-packages link.
+    The requirements of the overwrite resource are installed offline along with the
+    python-packages. The packages are installed again if their environment has disappeared
+    from the store.
+
+    Args:
+        config: charm configuration to apply, the current charm configuration by default.
+
+    Returns:
+        True if the dynamic-packages have been switched to another environment.
+    """
+    python_packages = (charm_config() if config is None else config)["python-packages"]
+    packages_digest = text_digest(python_packages)
+    if state.resource:
+        packages_digest = text_digest(json.dumps([python_packages, state.resource]))
+    if packages_digest != state.packages or not dynamic_packages_available():
+        with timed_phase("packages"):
+            switch_dynamic_packages(package_env(python_packages))
+            evict_package_envs()
+            state.update(packages=packages_digest)
+        return True
+    return False
+
+
+def materialise_src_file(filename: str, content: bytes, digest: str) -> bool:
+    """Write a src file unless its current content already has the expected digest.
+
+    The file content is hashed rather than trusting the manifest, the file may have been
+    replaced by a charm upgrade or edited outside of the charm since it was written.
+    """
+    path = SRC_DIR / filename
+    if path.is_file() and hashlib.sha256(path.read_bytes()).hexdigest() == digest:
+        return False
+    write_file_atomic(path, content)
+    return True
+
+
+def archive_member_path(name: str) -> str:
+    """Normalise the path of an archive member or file map key, rejecting paths outside of it."""
+    path = pathlib.PurePosixPath(name)
+    if path.is_absolute() or ".." in path.parts:
+        raise ValueError(f"path {name} is outside of the archive or file map root")
+    return str(path)
+
+
+def read_src_overwrite_archive(src_overwrite: str, digest: str) -> typing.Dict[str, bytes]:
+    """Decode a src-overwrite archive, a base64 encoded zip or (compressed) tar file."""
+    import base64
+    import io
+    import tarfile
+    import zipfile
+
+    archive = base64.b64decode(src_overwrite.partition("\n")[2])
+    if hashlib.sha256(archive).hexdigest() != digest:
+        raise ValueError("src-overwrite archive doesn't match the sha256 in its header")
+    files = {}
+    if zipfile.is_zipfile(io.BytesIO(archive)):
+        with zipfile.ZipFile(io.BytesIO(archive)) as archive_zip:
+            for info in archive_zip.infolist():
+                if not info.is_dir():
+                    files[info.filename] = archive_zip.read(info)
+    else:
+        with tarfile.open(fileobj=io.BytesIO(archive)) as archive_tar:
+            for member in archive_tar.getmembers():
+                if member.isfile():
+                    files[member.name] = archive_tar.extractfile(member).read()
+    return {archive_member_path(name): content for name, content in files.items()}
+
+
+def read_src_overwrite(src_overwrite: str, archive_digest: typing.Optional[str]):
+    """Read the src file contents of a src-overwrite file map or archive."""
+    if archive_digest is not None:
+        return read_src_overwrite_archive(src_overwrite, archive_digest)
+    import yaml
+
+    # the keys are confined to the src directory, written and later removed files alike
+    return {
+        archive_member_path(filename): content.encode("utf-8")
+        for filename, content in yaml.safe_load(src_overwrite).items()
+    }
+
+
+def fetch_resource() -> typing.Optional[pathlib.Path]:
+    """Get the path of the overwrite resource, None if no or an empty resource is attached."""
+    count_hook_tool_call("resource-get")
+    try:
+        path = subprocess.check_output(
+            ["resource-get", RESOURCE_NAME], stderr=subprocess.DEVNULL, text=True
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    resource = pathlib.Path(path.strip())
+    return resource if resource.stat().st_size else None
+
+
+def unpack_resource():
+    """Unpack the overwrite resource, once per resource revision.
+
+    The resource is a (compressed) tar file with src files under src/, wheels under wheels/
+    and an optional requirements.txt naming the packages to install from the wheels, every
+    wheel is installed if it's absent.
+    """
+    import shutil
+    import tarfile
+
+    resource = fetch_resource()
+    digest = file_digest(resource) if resource else ""
+    if digest == state.resource:
+        return
+    tmp_dir = RESOURCE_DIR.with_name(f"{RESOURCE_DIR.name}.tmp")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    tmp_dir.mkdir()
+    if resource:
+        with tarfile.open(resource) as archive:
+            for member in archive.getmembers():
+                if not member.isfile():
+                    continue
+                path = tmp_dir / archive_member_path(member.name)
+                path.parent.mkdir(parents=True, exist_ok=True)
+                with archive.extractfile(member) as src, open(path, "wb") as dst:
+                    shutil.copyfileobj(src, dst)
+    shutil.rmtree(RESOURCE_DIR, ignore_errors=True)
+    os.replace(tmp_dir, RESOURCE_DIR)
+    wheelhouse_wheels.cache_clear()
+    # the src files of the resource have to be materialised again, even for the same archive
+    state.update(resource=digest, archive="")
+    juju_log(f"unpacked {RESOURCE_NAME} resource {digest or '(none)'}")
+
+
+def resource_src_files() -> typing.Dict[str, bytes]:
+    """Read the src files of the unpacked overwrite resource."""
+    if not RESOURCE_SRC_DIR.is_dir():
+        return {}
+    return {
+        str(path.relative_to(RESOURCE_SRC_DIR)): path.read_bytes()
+        for path in RESOURCE_SRC_DIR.rglob("*")
+        if path.is_file()
+    }
+
+
+def resource_requirements() -> typing.List[str]:
+    """Get the requirements to install from the wheels of the unpacked overwrite resource."""
+    from packaging.utils import parse_wheel_filename
+
+    if RESOURCE_REQUIREMENTS_PATH.is_file():
+        lines = RESOURCE_REQUIREMENTS_PATH.read_text(encoding="utf-8").splitlines()
+        return [line for line in lines if line.strip() and not line.startswith("#")]
+    if not RESOURCE_WHEELS_DIR.is_dir():
+        return []
+    return sorted(
+        {str(parse_wheel_filename(wheel.name)[0]) for wheel in RESOURCE_WHEELS_DIR.glob("*.whl")}
+    )
+
+
+def src_overwrite(config: typing.Optional[dict] = None):
+    """Update the src file contents based on the charm configuration.
+
+    Only files whose content hash differs from the applied manifest are written, and files
+    written by a previous src-overwrite but no longer configured are removed. An archive with
+    the same hash as the applied one isn't decoded at all.
+
+    Args:
+        config: charm configuration to apply, the current charm configuration by default.
+
+    Returns:
+        The number of src files written and the list of stale src files removed.
+    """
+    src_overwrite_config = (charm_config() if config is None else config)["src-overwrite"]
+    archive_digest = src_overwrite_archive_digest(src_overwrite_config)
+    if archive_digest is not None and archive_digest == state.archive:
+        juju_log("src-overwrite archive unchanged, skipped")
+        return {"written": 0, "removed": []}
+    applied_manifest = state.manifest
+    manifest = {}
+    written_files = written_bytes = 0
+    for src_overwrite_filename, content in {
+        **{filename: content.encode("utf-8") for filename, content in state.original.items()},
+        **resource_src_files(),
+        **read_src_overwrite(src_overwrite_config, archive_digest),
     }.items():
         overwrite_path = SRC_DIR / src_overwrite_filename
         if overwrite_path.exists() and THIS_FILE.samefile(overwrite_path):
             continue
-        overwrite_path.parent.mkdir(exist_ok=True)
-        overwrite_path.write_text(src_overwrite_file_content)
+        digest = hashlib.sha256(content).hexdigest()
+        if materialise_src_file(src_overwrite_filename, content, digest):
+            written_files += 1
+            written_bytes += len(content)
+        manifest[src_overwrite_filename] = digest
+    stale_files = sorted(set(applied_manifest) - set(manifest))
+    for stale_file in stale_files:
+        (SRC_DIR / stale_file).unlink(missing_ok=True)
+    if written_files or stale_files:
+        compile_bytecode(SRC_DIR, "src")
+    if manifest != applied_manifest or (archive_digest or "") != state.archive:
+        state.update(manifest=manifest, archive=archive_digest or "")
+    juju_log(
+        f"src-overwrite wrote {written_files} files ({written_bytes} bytes), "
+        f"removed {len(stale_files)} stale files"
+    )
+    return {"written": written_files, "removed": stale_files}
+
+
+def prelude():
+    """Prepare the charm source and packages, skipping everything if the config is unchanged.
+
+    The overwrite resource is only looked up in the install and upgrade-charm hooks, attaching
+    a new resource revision triggers the upgrade-charm hook. The reset action dispatch always
+    applies the default src-overwrite and python-packages, before the AnyCharm is imported,
+    so it's handled by the pristine AnyCharm even if the src-overwrite broke the charm.
+    """
+    with timed_phase("prelude"):
+        if dispatch_event_name() == "upgrade_charm":
+            state.check_upgrade()
+        if dispatch_event_name() in ("install", "upgrade_charm"):
+            with timed_phase("resource"):
+                unpack_resource()
+        reset = dispatch_event_name() == "reset_action"
+        config = charm_config()
+        if reset:
+            # the next dispatch applies the configured values again, unless they're reset too
+            config = {**config, **RESET_CONFIG}
+        fingerprint = config_fingerprint(config)
+        fast_path = fingerprint == state.fingerprint and not reset and dynamic_packages_available()
+        if not fast_path:
+            preserve_original()
+            packages_switched = install_packages(config)
+            with timed_phase("src"):
+                src_report = src_overwrite(config)
+            state.update(fingerprint=fingerprint)
+            if reset:
+                report = {"src": src_report, "dynamic-packages": packages_switched}
+                write_file_atomic(RESET_REPORT_PATH, json.dumps(report).encode("utf-8"))
+    if config.get("hook-stats", False):
+        # juju-log is a subprocess, the fast path mustn't pay for it unless it's being measured
+        juju_log(
+            f"charm.py prelude took {phase_timings['prelude']:.3f}s "
+            f"({'fast path, config unchanged' if fast_path else 'config applied'})",
+            level="DEBUG",
+        )
+
+
+def dispatch_event_name() -> str:
+    """Get the name of the event being dispatched, like config_changed or rpc_action."""
+    kind, _, name = os.environ.get("JUJU_DISPATCH_PATH", "").rpartition("/")
+    event = name.replace("-", "_")
+    return f"{event}_action" if kind == "actions" else event
+
+
+def take_profile_request(event: str) -> bool:
+    """Check if the dispatch of the event should be profiled and consume one profile request."""
+    if not PROFILE_REQUEST_PATH.exists():
+        return False
+    request = json.loads(PROFILE_REQUEST_PATH.read_text(encoding="utf-8"))
+    if request["event"] != event:
+        return False
+    if request["count"] <= 1:
+        PROFILE_REQUEST_PATH.unlink()
+    else:
+        request["count"] -= 1
+        write_file_atomic(PROFILE_REQUEST_PATH, json.dumps(request).encode("utf-8"))
+    return True
+
+
+def time_charm_init(charm_class: type, charms: list):
+    """Measure the charm construction in the charm-init phase and collect the charm instance."""
+    charm_init = charm_class.__init__
+
+    def timed_charm_init(self, *args, **kwargs):
+        with timed_phase("charm-init"):
+            charm_init(self, *args, **kwargs)
+        charms.append(self)
+
+    # patch the class in place, a subclass would change the handle paths of the charm
+    charm_class.__init__ = timed_charm_init
+
+
+def record_hook_stats(event: str, charms: list):
+    """Append the stats of this dispatch to the hook stats ring buffer."""
+    phases = dict(phase_timings)
+    phases["events"] = phases.get("main", 0.0) - phases.get("charm-init", 0.0)
+    calls = dict(hook_tool_calls)
+    for tool, count in (getattr(charms[0], "hook_tool_calls", {}) if charms else {}).items():
+        calls[tool] = calls.get(tool, 0) + count
+    record = {"event": event, "time": time.time(), "phases": phases, "hook-tool-calls": calls}
+    append_bounded_log(HOOK_STATS_PATH, [json.dumps(record)], HOOK_STATS_MAX_SIZE, HOOK_STATS_KEEP)
+
+
+def rpc_server_running(pid: int) -> bool:
+    """Check if the process is an rpc server, the pid may have been reused after it exited."""
+    try:
+        return RPC_SERVER_SCRIPT.encode() in pathlib.Path(f"/proc/{pid}/cmdline").read_bytes()
+    except OSError:
+        return False
+
+
+def start_rpc_server(address: str) -> int:
+    """Start the rpc server in its own session, so it outlives the dispatch."""
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join(path for path in sys.path if path)}
+    with open(RPC_SERVER_LOG_PATH, "ab") as log_file:
+        process = subprocess.Popen(
+            [sys.executable, str(SRC_DIR / RPC_SERVER_SCRIPT), address],
+            cwd=CHARM_DIR,
+            env=env,
+            stdin=subprocess.DEVNULL,
+            stdout=log_file,
+            stderr=log_file,
+            start_new_session=True,
+        )
+    return process.pid
+
+
+def stop_rpc_server(pid: int):
+    """Terminate the rpc server and wait for it to release its address."""
+    import signal
+
+    os.kill(pid, signal.SIGTERM)
+    deadline = time.monotonic() + RPC_SERVER_STOP_TIMEOUT
+    while rpc_server_running(pid) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    if rpc_server_running(pid):
+        os.kill(pid, signal.SIGKILL)
+    juju_log(f"stopped rpc server {pid}")
+
+
+def supervise_rpc_server(event: str):
+    """Start, restart or stop the rpc server to match the rpc-server config.
+
+    The server is restarted if it has exited or the applied config, which includes
+    src-overwrite and python-packages, has changed since it was started.
+    """
+    address = charm_config().get("rpc-server", "")
+    if not address and not RPC_SERVER_STATE_PATH.exists():
+        return
+    server = {}
+    if RPC_SERVER_STATE_PATH.exists():
+        server = json.loads(RPC_SERVER_STATE_PATH.read_text(encoding="utf-8"))
+    if event in ("stop", "remove"):
+        address = ""
+    key = [address, state.fingerprint]
+    running = bool(server) and rpc_server_running(server["pid"])
+    if running and server["key"] == key:
+        return
+    if running:
+        stop_rpc_server(server["pid"])
+    if not address:
+        RPC_SERVER_STATE_PATH.unlink(missing_ok=True)
+        return
+    pid = start_rpc_server(address)
+    write_file_atomic(RPC_SERVER_STATE_PATH, json.dumps({"pid": pid, "key": key}).encode())
+    juju_log(f"started rpc server {pid} on {address}")
+
+
+def run_charm(event: str):
+    """Apply the config and run the AnyCharm for the dispatched event."""
+    hook_stats = charm_config().get("hook-stats", False)
+    charms: list = []
+    try:
+        with timed_phase("total"):
+            prelude()
+            sys.path.append(str(SRC_DIR))
+            sys.path.append(str(DYNAMIC_PACKAGES_PATH))
+            supervise_rpc_server(event)
+            with timed_phase("import"):
+                from any_charm import AnyCharm
+            if hook_stats:
+                time_charm_init(AnyCharm, charms)
+            with timed_phase("main"):
+                main(AnyCharm)
+    finally:
+        if hook_stats:
+            record_hook_stats(event, charms)
+
+
+def dispatch():
+    """Dispatch the Juju event, under cProfile if a profile of the event has been requested."""
+    event = dispatch_event_name()
+    if not take_profile_request(event):
+        run_charm(event)
+        return
+    import cProfile
+
+    profiler = cProfile.Profile()
+    try:
+        profiler.runcall(run_charm, event)
+    finally:
+        PROFILE_DIR.mkdir(exist_ok=True)
+        profiler.dump_stats(PROFILE_DIR / f"{event}-{time.time():.0f}.pstats")
 
 
 if __name__ == "__main__":
-    preserve_original()
-    install_packages()
-    src_overwrite()
-    sys.path.append(str(SRC_DIR))
-    sys.path.append(str(DYNAMIC_PACKAGES_PATH))
-    from any_charm import AnyCharm
-
-    main(AnyCharm)
+    dispatch()
@@ -0,0 +1,50 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""File helpers shared by the charm.py entrypoint and the AnyCharmBase.
+
+The entrypoint imports this module in every dispatch, so it must only import modules ops
+imports anyway.
+"""
+
+import hashlib
+import os
+import pathlib
+import typing
+
+
+def write_file_atomic(path: pathlib.Path, content: bytes, mode: typing.Optional[int] = None):
+    """Write a file through a temporary file and rename, so a partial file is never visible.
+
+    Args:
+        path: the file to write, its parent directories are created if needed.
+        content: the file content.
+        mode: the file permissions, the umask applies if unset.
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666 if mode is None else mode)
+    if mode is not None:
+        # a leftover temporary file keeps its mode, O_CREAT only applies mode to new files
+        os.fchmod(fd, mode)
+    with open(fd, "wb") as tmp_file:
+        tmp_file.write(content)
+    os.replace(tmp_path, path)
+
+
+def append_bounded_log(path: pathlib.Path, lines: typing.List[str], max_size: int, keep: int):
+    """Append lines to a log file, keeping only the last keep lines once it exceeds max_size."""
+    with open(path, "a", encoding="utf-8") as log_file:
+        log_file.write("".join(line + "\n" for line in lines))
+    if path.stat().st_size > max_size:
+        kept_lines = path.read_text(encoding="utf-8").splitlines(keepends=True)[-keep:]
+        write_file_atomic(path, "".join(kept_lines).encode("utf-8"))
+
+
+def file_digest(path: pathlib.Path) -> str:
+    """Calculate the sha256 hex digest of a file."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
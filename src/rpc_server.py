@@ -0,0 +1,91 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Unit-local rpc server, started and supervised by the charm.py entrypoint.
+
+The server imports the AnyCharm once and serves the methods named in its RPC_SERVER_METHODS
+over a Unix socket or TCP connection, without going through a Juju action. The methods are
+called on an AnyCharm instance that hasn't been constructed by the ops framework, so they
+can't use the Juju model or the framework.
+
+The protocol is newline-delimited JSON, each request {"method": ..., "args": [...],
+"kwargs": {...}} is answered with {"return": ...} or {"error": ...} in order, and a
+connection can be used for any number of requests.
+"""
+
+import json
+import logging
+import os
+import socketserver
+import sys
+import typing
+
+logger = logging.getLogger(__name__)
+
+
+class RpcRequestHandler(socketserver.StreamRequestHandler):
+    """Handle the rpc requests of one connection."""
+
+    def handle(self):
+        """Answer requests until the client closes the connection."""
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                method = self.server.methods.get(request["method"])
+                if method is None:
+                    raise LookupError(f"method {request['method']} isn't served by the rpc server")
+                result = method(*request.get("args", []), **request.get("kwargs", {}))
+                response = json.dumps({"return": result})
+            except Exception as exc:
+                logger.exception("error while handling rpc server request")
+                response = json.dumps({"error": repr(exc)})
+            self.wfile.write(response.encode("utf-8") + b"\n")
+
+
+class RpcServerMixIn(socketserver.ThreadingMixIn):
+    """Serve each connection in a thread with the methods to serve."""
+
+    daemon_threads = True
+    methods: typing.Dict[str, typing.Callable] = {}
+
+
+class UnixRpcServer(RpcServerMixIn, socketserver.UnixStreamServer):
+    """Rpc server listening on a Unix socket."""
+
+
+class TcpRpcServer(RpcServerMixIn, socketserver.TCPServer):
+    """Rpc server listening on a TCP address."""
+
+    allow_reuse_address = True
+
+
+def load_methods() -> typing.Dict[str, typing.Callable]:
+    """Import the AnyCharm and get the methods it declares to be served."""
+    from any_charm import AnyCharm
+
+    charm = AnyCharm.__new__(AnyCharm)
+    return {name: getattr(charm, name) for name in getattr(AnyCharm, "RPC_SERVER_METHODS", ())}
+
+
+def create_server(address: str) -> RpcServerMixIn:
+    """Create the rpc server, an absolute path is a Unix socket and host:port a TCP address."""
+    if address.startswith("/"):
+        if os.path.exists(address):
+            os.unlink(address)
+        return UnixRpcServer(address, RpcRequestHandler)
+    host, _, port = address.rpartition(":")
+    return TcpRpcServer((host, int(port)), RpcRequestHandler)
+
+
+def main(address: str):
+    """Serve the AnyCharm rpc server methods until terminated."""
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    methods = load_methods()
+    with create_server(address) as server:
+        server.methods = methods
+        logger.info("serving %s on %s", sorted(methods), address)
+        server.serve_forever()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1])
@@ -0,0 +1,409 @@
+#!/usr/bin/env python3
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Offline benchmarks of the any-charm dispatch.
+
+Each benchmark dispatches the charm.py of a copy of the charm, the way the Juju agent does,
+against a fake model served by fake hook tools (see hook_tool.py) with a simulated latency per
+hook tool call. The dispatch time, the hook tool calls and the peak memory of every dispatch are
+measured while scaling the number of related applications and units, the src-overwrite size and
+the python-packages count. The results can be saved as a baseline and compared with it, so
+regressions show up without a Juju controller.
+"""
+
+import argparse
+import collections
+import importlib.util
+import json
+import os
+import pathlib
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import typing
+import zipfile
+
+import yaml
+
+BENCHMARK_DIR = pathlib.Path(__file__).parent
+CHARM_DIR = BENCHMARK_DIR.parent.parent
+BASELINE_PATH = BENCHMARK_DIR / "baseline.json"
+BASELINE_VERSION = 1
+HOOK_TOOLS = (
+    "action-fail",
+    "action-get",
+    "action-log",
+    "action-set",
+    "application-version-set",
+    "config-get",
+    "goal-state",
+    "is-leader",
+    "juju-log",
+    "relation-get",
+    "relation-ids",
+    "relation-list",
+    "relation-set",
+    "status-get",
+    "status-set",
+)
+UNIT_NAME = "any-charm/0"
+DATABAG_KEYS = 8
+DATABAG_VALUE_SIZE = 64
+SRC_FILE_SIZE = 16 * 1024
+WHEEL_MODULES = 8
+WHEEL_MODULE_SIZE = 4 * 1024
+RELATION_SCALES = [(1, 1), (4, 1), (4, 4), (16, 4)]
+SRC_OVERWRITE_SCALES = [1, 16, 64]
+PYTHON_PACKAGES_SCALES = [1, 8, 32]
+
+
+class BenchmarkError(Exception):
+    """A benchmarked dispatch failed."""
+
+
+class DispatchResult(typing.NamedTuple):
+    """The measurements of one dispatch."""
+
+    dispatch_time: float
+    peak_memory: int
+    hook_tool_calls: typing.Dict[str, int]
+    phases: typing.Dict[str, float]
+
+
+def import_script(path: pathlib.Path):
+    """Import a script that is not part of a package."""
+    spec = importlib.util.spec_from_file_location(path.stem, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def build_wheel(wheelhouse: pathlib.Path, name: str):
+    """Build a pure Python wheel with a few modules into the wheelhouse."""
+    filler = "x" * WHEEL_MODULE_SIZE
+    with zipfile.ZipFile(wheelhouse / f"{name}-1.0-py3-none-any.whl", "w") as wheel:
+        wheel.writestr(f"{name}/__init__.py", "VERSION = '1.0'\n")
+        for idx in range(WHEEL_MODULES):
+            wheel.writestr(f"{name}/module{idx}.py", f"DATA = {filler!r}\n")
+        wheel.writestr(f"{name}-1.0.dist-info/METADATA", f"Name: {name}\nVersion: 1.0\n")
+
+
+def databag(owner: str) -> typing.Dict[str, str]:
+    """Generate the relation data of an application or unit."""
+    return {f"{owner}-key-{idx}": "v" * DATABAG_VALUE_SIZE for idx in range(DATABAG_KEYS)}
+
+
+def relations_model(apps: int, units: int) -> typing.List[dict]:
+    """Generate relations with the given number of remote applications and units per app."""
+    relations = []
+    for app_idx in range(apps):
+        app = f"remote-{app_idx}"
+        app_units = [f"{app}/{unit_idx}" for unit_idx in range(units)]
+        data = {app: databag(app), **{unit: databag(unit) for unit in app_units}}
+        relations.append(
+            {
+                "id": app_idx,
+                "endpoint": "provide-any" if app_idx % 2 == 0 else "require-any",
+                "app": app,
+                "units": app_units,
+                "data": data,
+            }
+        )
+    return relations
+
+
+class FakeJuju:
+    """A unit of any-charm deployed on a fake Juju machine in a temporary directory."""
+
+    def __init__(self, root: pathlib.Path, latency: float, wheels: int = 0):
+        """Deploy the charm and the fake hook tools into the root directory."""
+        self.root = root
+        self.latency = latency
+        self.bin_dir = root / "bin"
+        self.charm_dir = root / "agents" / "unit-any-charm-0" / "charm"
+        self.model_path = root / "model.json"
+        self.calls_path = root / "calls.jsonl"
+        self.stderr_path = root / "stderr.txt"
+        self._install_hook_tools()
+        self._install_charm(wheels)
+        config = yaml.safe_load((CHARM_DIR / "config.yaml").read_text(encoding="utf-8"))
+        self.actions = yaml.safe_load((CHARM_DIR / "actions.yaml").read_text(encoding="utf-8"))
+        self.model = {
+            "config": {name: option.get("default") for name, option in config["options"].items()},
+            "action-params": {},
+            "leader": True,
+            "units": [UNIT_NAME],
+            "relations": [],
+        }
+        self.model["config"]["hook-stats"] = True
+
+    def _install_hook_tools(self):
+        self.bin_dir.mkdir(parents=True)
+        hook_tool = BENCHMARK_DIR / "hook_tool.py"
+        for tool in HOOK_TOOLS:
+            wrapper = self.bin_dir / tool
+            wrapper.write_text(
+                f'#!/bin/sh\nexec "{sys.executable}" -I -S "{hook_tool}" {tool} "$@"\n',
+                encoding="utf-8",
+            )
+            wrapper.chmod(0o755)
+
+    def _install_charm(self, wheels: int):
+        (self.charm_dir / "src").mkdir(parents=True)
+        for file in (CHARM_DIR / "src").glob("*.py"):
+            shutil.copy(file, self.charm_dir / "src")
+        for file in ("metadata.yaml", "actions.yaml", "config.yaml"):
+            shutil.copy(CHARM_DIR / file, self.charm_dir)
+        if wheels:
+            wheelhouse = self.charm_dir / "wheelhouse"
+            wheelhouse.mkdir()
+            for idx in range(wheels):
+                build_wheel(wheelhouse, f"benchpkg{idx}")
+            import_script(CHARM_DIR / "scripts" / "build_wheelhouse_index.py").main(wheelhouse)
+
+    def dispatch(self, dispatch_path: str, **action_params) -> DispatchResult:
+        """Dispatch a hook or action to the charm and measure it."""
+        if dispatch_path.startswith("actions/"):
+            params = self.actions[dispatch_path.rpartition("/")[2]].get("params", {})
+            self.model["action-params"] = {
+                **{name: param["default"] for name, param in params.items() if "default" in param},
+                **action_params,
+            }
+        self.model_path.write_text(json.dumps(self.model), encoding="utf-8")
+        self.calls_path.write_text("", encoding="utf-8")
+        env = {
+            key: value
+            for key, value in os.environ.items()
+            if not key.startswith("JUJU_") and key != "PYTHONPATH"
+        }
+        env.update(
+            PATH=f"{self.bin_dir}{os.pathsep}{env.get('PATH', '')}",
+            JUJU_DISPATCH_PATH=dispatch_path,
+            JUJU_CHARM_DIR=str(self.charm_dir),
+            JUJU_UNIT_NAME=UNIT_NAME,
+            JUJU_MODEL_NAME="benchmark",
+            JUJU_VERSION="3.6.0",
+            FAKE_JUJU_LATENCY=str(self.latency),
+            FAKE_JUJU_MODEL=str(self.model_path),
+            FAKE_JUJU_CALLS=str(self.calls_path),
+            ANY_CHARM_PACKAGE_STORE=str(self.root / "package-store"),
+        )
+        if dispatch_path.startswith("actions/"):
+            env["JUJU_ACTION_NAME"] = dispatch_path.rpartition("/")[2]
+            env["JUJU_ACTION_UUID"] = "1"
+        with open(self.stderr_path, "wb") as stderr:
+            start = time.perf_counter()
+            process = subprocess.Popen(
+                [sys.executable, str(self.charm_dir / "src" / "charm.py")],
+                cwd=self.charm_dir,
+                env=env,
+                stdout=subprocess.DEVNULL,
+                stderr=stderr,
+            )
+            _, status, rusage = os.wait4(process.pid, 0)
+            dispatch_time = time.perf_counter() - start
+        process.returncode = status
+        calls = [
+            json.loads(line) for line in self.calls_path.read_text(encoding="utf-8").splitlines()
+        ]
+        if status != 0:
+            stderr_tail = self.stderr_path.read_text(encoding="utf-8")[-2000:]
+            raise BenchmarkError(f"dispatch of {dispatch_path} failed:\n{stderr_tail}")
+        for call in calls:
+            if call[0] == "action-fail":
+                raise BenchmarkError(f"action {dispatch_path} failed: {call[1:]}")
+        hook_stats = (self.charm_dir / ".any-charm-hook-stats").read_text(encoding="utf-8")
+        return DispatchResult(
+            dispatch_time=dispatch_time,
+            peak_memory=rusage.ru_maxrss,
+            hook_tool_calls=dict(collections.Counter(call[0] for call in calls)),
+            phases=json.loads(hook_stats.splitlines()[-1])["phases"],
+        )
+
+
+class Benchmark:
+    """Run the benchmark scenarios and collect the results."""
+
+    def __init__(self, latency: float, repeat: int):
+        """Initialize the benchmark."""
+        self.latency = latency
+        self.repeat = repeat
+        self.results: typing.List[dict] = []
+        self._tmp_dir = pathlib.Path(tempfile.mkdtemp(prefix="any-charm-benchmark-"))
+        self._deployments = 0
+
+    def close(self):
+        """Remove the fake deployments."""
+        shutil.rmtree(self._tmp_dir, ignore_errors=True)
+
+    def deploy(self, wheels: int = 0) -> FakeJuju:
+        """Deploy a fresh any-charm unit on a fake Juju machine."""
+        self._deployments += 1
+        return FakeJuju(self._tmp_dir / str(self._deployments), self.latency, wheels)
+
+    def record(self, name: str, params: dict, runs: typing.List[DispatchResult]):
+        """Summarise the runs of a benchmark into a result."""
+        result = {
+            "name": name,
+            "params": params,
+            "dispatch-time": statistics.median(run.dispatch_time for run in runs),
+            "peak-memory": max(run.peak_memory for run in runs),
+            "hook-tool-calls": runs[-1].hook_tool_calls,
+            "phases": runs[-1].phases,
+        }
+        self.results.append(result)
+        print(
+            f"{name:<36} {json.dumps(params):<32} {result['dispatch-time']:8.3f}s "
+            f"{sum(result['hook-tool-calls'].values()):6d} calls "
+            f"{result['peak-memory'] / 1024:7.1f} MiB",
+            flush=True,
+        )
+
+    def run_cold_and_warm(
+        self, scenario: str, params: dict, config: dict, wheels: int = 0
+    ) -> FakeJuju:
+        """Benchmark the config-changed that applies a config and the ones after it."""
+        cold_runs = []
+        for _ in range(self.repeat):
+            fake_juju = self.deploy(wheels)
+            fake_juju.model["config"].update(config)
+            cold_runs.append(fake_juju.dispatch("hooks/config-changed"))
+        self.record(f"{scenario}/config-changed-cold", params, cold_runs)
+        warm_runs = [fake_juju.dispatch("hooks/config-changed") for _ in range(self.repeat)]
+        self.record(f"{scenario}/config-changed-warm", params, warm_runs)
+        return fake_juju
+
+    def bench_relations(self):
+        """Scale the number of related applications and units."""
+        for apps, units in RELATION_SCALES:
+            fake_juju = self.deploy()
+            fake_juju.model["relations"] = relations_model(apps, units)
+            fake_juju.dispatch("hooks/config-changed")
+            params = {"apps": apps, "units": units}
+            self.record(
+                "relations/update-status",
+                params,
+                [fake_juju.dispatch("hooks/update-status") for _ in range(self.repeat)],
+            )
+            self.record(
+                "relations/get-relation-data",
+                params,
+                [fake_juju.dispatch("actions/get-relation-data") for _ in range(self.repeat)],
+            )
+
+    def bench_src_overwrite(self):
+        """Scale the number of files in the src-overwrite."""
+        for files in SRC_OVERWRITE_SCALES:
+            filler = "x" * SRC_FILE_SIZE
+            src_overwrite = {
+                f"bench_module_{idx}.py": f"DATA = {filler!r}\n" for idx in range(files)
+            }
+            self.run_cold_and_warm(
+                "src-overwrite",
+                {"files": files, "bytes": files * SRC_FILE_SIZE},
+                {"src-overwrite": json.dumps(src_overwrite)},
+            )
+
+    def bench_python_packages(self):
+        """Scale the number of python-packages installed from the wheelhouse."""
+        for packages in PYTHON_PACKAGES_SCALES:
+            python_packages = "\n".join(f"benchpkg{idx}" for idx in range(packages))
+            self.run_cold_and_warm(
+                "python-packages",
+                {"packages": packages},
+                {"python-packages": python_packages},
+                wheels=packages,
+            )
+
+    def run(self, scenarios: typing.List[str]):
+        """Run the benchmark scenarios."""
+        for scenario in scenarios:
+            getattr(self, f"bench_{scenario.replace('-', '_')}")()
+
+
+def result_key(result: dict) -> str:
+    """Identify a benchmark result across runs."""
+    return f"{result['name']} {json.dumps(result['params'], sort_keys=True)}"
+
+
+def compare(
+    results: typing.List[dict], baseline: dict, time_tolerance: float, memory_tolerance: float
+) -> typing.List[str]:
+    """Compare the results with the baseline and describe the regressions.
+
+    The hook tool calls are deterministic and may not increase at all, the dispatch time and
+    the peak memory depend on the machine and may not exceed the baseline times the tolerance.
+    """
+    baseline_results = {result_key(result): result for result in baseline["results"]}
+    regressions = []
+    for result in results:
+        expected = baseline_results.get(result_key(result))
+        if expected is None:
+            continue
+        calls = sum(result["hook-tool-calls"].values())
+        expected_calls = sum(expected["hook-tool-calls"].values())
+        if calls > expected_calls:
+            regressions.append(
+                f"{result_key(result)}: {calls} hook tool calls, baseline {expected_calls}"
+            )
+        if result["dispatch-time"] > expected["dispatch-time"] * time_tolerance:
+            regressions.append(
+                f"{result_key(result)}: dispatch took {result['dispatch-time']:.3f}s, "
+                f"baseline {expected['dispatch-time']:.3f}s"
+            )
+        if result["peak-memory"] > expected["peak-memory"] * memory_tolerance:
+            regressions.append(
+                f"{result_key(result)}: peak memory {result['peak-memory']} KiB, "
+                f"baseline {expected['peak-memory']} KiB"
+            )
+    return regressions
+
+
+def main():
+    """Run the benchmarks, save the results and compare them with the baseline."""
+    scenarios = ["relations", "src-overwrite", "python-packages"]
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scenario", action="append", choices=scenarios)
+    parser.add_argument("--latency", type=float, default=0.01, help="seconds per hook tool call")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", type=pathlib.Path, help="write the results to this file")
+    parser.add_argument("--baseline", type=pathlib.Path, default=BASELINE_PATH)
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--time-tolerance", type=float, default=1.5)
+    parser.add_argument("--memory-tolerance", type=float, default=1.25)
+    args = parser.parse_args()
+
+    benchmark = Benchmark(latency=args.latency, repeat=args.repeat)
+    try:
+        benchmark.run(args.scenario or scenarios)
+    finally:
+        benchmark.close()
+    output = {
+        "version": BASELINE_VERSION,
+        "python": ".".join(map(str, sys.version_info[:3])),
+        "latency": args.latency,
+        "results": benchmark.results,
+    }
+    if args.output:
+        args.output.write_text(json.dumps(output, indent=2) + "\n", encoding="utf-8")
+    if args.update_baseline:
+        args.baseline.write_text(json.dumps(output, indent=2) + "\n", encoding="utf-8")
+        return
+    if not args.baseline.exists():
+        return
+    baseline = json.loads(args.baseline.read_text(encoding="utf-8"))
+    if baseline["latency"] != args.latency:
+        sys.exit(f"baseline was measured with {baseline['latency']}s hook tool latency")
+    regressions = compare(benchmark.results, baseline, args.time_tolerance, args.memory_tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Fake Juju hook tool used by the offline benchmarks.
+
+Every hook tool on the PATH of a benchmarked dispatch is a wrapper that runs this script with
+the tool name as the first argument. The script sleeps for the simulated hook tool latency,
+appends the call to the call log and answers from the fake model file. Only the standard
+library is used and the interpreter runs without site packages to keep the fixed cost low.
+"""
+
+import json
+import os
+import sys
+import time
+
+SINCE = "2024-01-01T00:00:00Z"
+
+
+def option(args: list, name: str):
+    """Get the value of a command line option like -r 1, or None."""
+    if name in args:
+        return args[args.index(name) + 1]
+    return None
+
+
+def positional(args: list) -> list:
+    """Get the positional arguments of a hook tool command line."""
+    positionals = []
+    skip = False
+    for arg in args:
+        if skip:
+            skip = False
+        elif arg == "-r":
+            skip = True
+        elif arg == "-" or not arg.startswith("-"):
+            positionals.append(arg)
+    return positionals
+
+
+def find_relation(model: dict, args: list) -> dict:
+    """Find the relation addressed by the -r option, which can be endpoint:id or id."""
+    relation_id = int(option(args, "-r").rpartition(":")[2])
+    return next(relation for relation in model["relations"] if relation["id"] == relation_id)
+
+
+def goal_state(model: dict) -> dict:
+    """Build the goal-state output of the fake model."""
+    relations: dict = {}
+    for relation in model["relations"]:
+        goals = relations.setdefault(relation["endpoint"], {})
+        goals[relation["app"]] = {"status": "joined", "since": SINCE}
+        for unit in relation["units"]:
+            goals[unit] = {"status": "active", "since": SINCE}
+    units = {unit: {"status": "active", "since": SINCE} for unit in model["units"]}
+    return {"units": units, "relations": relations}
+
+
+def relation_get(model: dict, args: list):
+    """Answer a relation-get command, for a whole databag or a single key."""
+    relation = find_relation(model, args)
+    positionals = positional(args)
+    key, entity = positionals if len(positionals) == 2 else (positionals[0], None)
+    data = relation["data"].get(entity or os.environ["JUJU_UNIT_NAME"], {})
+    return data if key == "-" else data.get(key)
+
+
+def answer(tool: str, args: list, model: dict):
+    """Get the JSON output of a hook tool call, or None for tools without output."""
+    if tool == "config-get":
+        return model["config"]
+    if tool == "action-get":
+        return model["action-params"]
+    if tool == "is-leader":
+        return model["leader"]
+    if tool == "goal-state":
+        return goal_state(model)
+    if tool == "relation-ids":
+        endpoint = positional(args)[0]
+        return [
+            f"{endpoint}:{relation['id']}"
+            for relation in model["relations"]
+            if relation["endpoint"] == endpoint
+        ]
+    if tool == "relation-list":
+        relation = find_relation(model, args)
+        return relation["app"] if "--app" in args else relation["units"]
+    if tool == "relation-get":
+        return relation_get(model, args)
+    if tool == "status-get":
+        return {"message": "", "status": "unknown", "status-data": {}}
+    return None
+
+
+def main(tool: str, args: list):
+    """Run the fake hook tool."""
+    time.sleep(float(os.environ.get("FAKE_JUJU_LATENCY", "0")))
+    with open(os.environ["FAKE_JUJU_CALLS"], "a", encoding="utf-8") as calls_file:
+        calls_file.write(json.dumps([tool, *args]) + "\n")
+    with open(os.environ["FAKE_JUJU_MODEL"], encoding="utf-8") as model_file:
+        model = json.load(model_file)
+    output = answer(tool, args, model)
+    if output is not None:
+        sys.stdout.write(json.dumps(output))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1], sys.argv[2:])
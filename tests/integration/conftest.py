@@ -1,9 +1,18 @@
 # Copyright 2024 Canonical Ltd.
 # See LICENSE file for licensing details.
 
+import asyncio
+import base64
+import gzip
+import hashlib
+import io
 import json
+import pathlib
 import platform
 import subprocess
+import tarfile
+import tempfile
+import zlib
 
 import pytest
 import pytest_asyncio
@@ -22,14 +31,80 @@ def run_action(ops_test: OpsTest):
 
 
 @pytest_asyncio.fixture
-def run_rpc(run_action):
+def decode_result(ops_test: OpsTest):
+    """Reassemble an action result value encoded with the result-encoding action param."""
+
+    async def _decode_result(application_name, results, key):
+        encoding = results.get(f"{key}-encoding", "json")
+        if encoding == "json":
+            return results[key]
+        if encoding == "zlib":
+            payload = "".join(
+                results[f"{key}-chunk-{idx}"] for idx in range(int(results[f"{key}-chunks"]))
+            )
+            return zlib.decompress(base64.b64decode(payload)).decode("utf-8")
+        unit = ops_test.model.applications[application_name].units[0]
+        with tempfile.TemporaryDirectory() as tmp:
+            local_path = pathlib.Path(tmp) / "result.json.gz"
+            await ops_test.juju("scp", f"{unit.name}:{results[f'{key}-path']}", str(local_path))
+            content = local_path.read_bytes()
+        assert hashlib.sha256(content).hexdigest() == results[f"{key}-sha256"]
+        return gzip.decompress(content).decode("utf-8")
+
+    return _decode_result
+
+
+@pytest_asyncio.fixture
+def run_rpc(run_action, decode_result):
     async def _run_rpc(application_name, action_name, **params):
         result = await run_action(application_name, action_name, **params)
-        return json.loads(result["return"])
+        return json.loads(await decode_result(application_name, result, "return"))
 
     return _run_rpc
 
 
+@pytest_asyncio.fixture
+def call_rpc_server(ops_test: OpsTest):
+    """Call a method served by the rpc server of the first unit, configured with rpc-server."""
+
+    async def _call_rpc_server(application_name, method, *args, port=8765, **kwargs):
+        unit = ops_test.model.applications[application_name].units[0]
+        address = await unit.get_public_address()
+        reader, writer = await asyncio.open_connection(address, port)
+        try:
+            request = {"method": method, "args": args, "kwargs": kwargs}
+            writer.write(json.dumps(request).encode("utf-8") + b"\n")
+            await writer.drain()
+            response = json.loads(await reader.readline())
+        finally:
+            writer.close()
+            await writer.wait_closed()
+        if "error" in response:
+            raise RuntimeError(response["error"])
+        return response["return"]
+
+    return _call_rpc_server
+
+
+@pytest.fixture
+def src_overwrite_archive():
+    """Pack a map of src file paths and contents into a src-overwrite archive config value."""
+
+    def _src_overwrite_archive(files):
+        buffer = io.BytesIO()
+        with tarfile.open(fileobj=buffer, mode="w:gz") as archive:
+            for path, content in files.items():
+                data = content.encode("utf-8")
+                info = tarfile.TarInfo(path)
+                info.size = len(data)
+                archive.addfile(info, io.BytesIO(data))
+        content = buffer.getvalue()
+        header = f"any-charm-archive/v1 sha256={hashlib.sha256(content).hexdigest()}"
+        return f"{header}\n{base64.b64encode(content).decode('ascii')}"
+
+    return _src_overwrite_archive
+
+
 @pytest.fixture(name="codename", scope="module")
 def codename_fixture():
     """Series codename for deploying any-charm."""
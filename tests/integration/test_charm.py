@@ -65,6 +65,14 @@ async def test_relation_and_config(ops_test, run_action):
     assert relation_data[0]["unit_data"]["this/0"]["value"] == "this/0"
     assert relation_data[0]["unit_data"]["other/0"]["value"] == "other/0"
 
+    results = await run_action("other", "get-relation-changes")
+    changes = json.loads(results["relation-changes"])
+    assert {"this": "this", "this/0": "this/0"} == {
+        change["entity"]: change["changed"]["value"] for change in changes
+    }
+    results = await run_action("other", "get-relation-changes", cursor=results["cursor"])
+    assert json.loads(results["relation-changes"]) == []
+
 
 async def test_overwrite_and_rpc_action(ops_test, run_action):
     overwrite_app_charm_script = textwrap.dedent("""\
@@ -96,6 +104,92 @@ async def test_overwrite_and_rpc_action(ops_test, run_action):
     )
     assert json.loads(results["return"]) == rpc_params
 
+    calls = [
+        {"method": "echo", "args": [1]},
+        {"method": "not_exist"},
+        {"method": "echo", "kwargs": {"a": "b"}},
+    ]
+    results = await run_action("this", "rpc", calls=json.dumps(calls), **{"stop-on-error": False})
+    batch_results = json.loads(results["return"])
+    assert batch_results[0] == {"return": {"args": [1], "kwargs": {}}}
+    assert "error" in batch_results[1]
+    assert batch_results[2] == {"return": {"args": [], "kwargs": {"a": "b"}}}
+
+
+@pytest.mark.parametrize("result_encoding", ["zlib", "file"])
+async def test_rpc_result_encoding(run_rpc, result_encoding):
+    payload = ["x" * 1000 + str(idx) for idx in range(1000)]
+    result = await run_rpc(
+        "this",
+        "rpc",
+        method="echo",
+        args=json.dumps(payload),
+        **{"result-encoding": result_encoding},
+    )
+    assert result == {"args": payload, "kwargs": {}}
+
+
+async def test_src_overwrite_archive(ops_test, run_action, src_overwrite_archive):
+    overwrite_app_charm_script = textwrap.dedent("""\
+    from any_charm_base import AnyCharmBase
+    from vendored.lib.identity import identity
+    class AnyCharm(AnyCharmBase):
+        def echo(self, *args, **kwargs):
+            return identity({"args": args, "kwargs": kwargs, "archive": True})
+    """)
+    archive = src_overwrite_archive(
+        {
+            "any_charm.py": overwrite_app_charm_script,
+            "vendored/__init__.py": "",
+            "vendored/lib/__init__.py": "",
+            "vendored/lib/identity.py": "identity = lambda x: x",
+        }
+    )
+    await ops_test.model.applications["this"].set_config({"src-overwrite": archive})
+    await ops_test.model.wait_for_idle(status="active")
+    results = await run_action("this", "rpc", method="echo")
+    assert json.loads(results["return"]) == {"args": [], "kwargs": {}, "archive": True}
+
+
+async def test_rpc_server(ops_test, call_rpc_server):
+    overwrite_app_charm_script = textwrap.dedent("""\
+    from any_charm_base import AnyCharmBase
+    class AnyCharm(AnyCharmBase):
+        RPC_SERVER_METHODS = ("echo",)
+        VERSION = {version}
+        def echo(self, *args, **kwargs):
+            return {{"args": args, "kwargs": kwargs, "version": self.VERSION}}
+    """)
+    app = ops_test.model.applications["this"]
+    await app.set_config(
+        {
+            "rpc-server": "0.0.0.0:8765",
+            "src-overwrite": json.dumps(
+                {"any_charm.py": overwrite_app_charm_script.format(version=1)}
+            ),
+        }
+    )
+    await ops_test.model.wait_for_idle(status="active")
+    for idx in range(100):
+        assert await call_rpc_server("this", "echo", idx, a="b") == {
+            "args": [idx],
+            "kwargs": {"a": "b"},
+            "version": 1,
+        }
+
+    await app.set_config(
+        {
+            "src-overwrite": json.dumps(
+                {"any_charm.py": overwrite_app_charm_script.format(version=2)}
+            )
+        }
+    )
+    await ops_test.model.wait_for_idle(status="active")
+    result = await call_rpc_server("this", "echo")
+    assert result["version"] == 2
+    await app.set_config({"rpc-server": ""})
+    await ops_test.model.wait_for_idle(status="active")
+
 
 async def test_recovery(ops_test, run_action):
     overwrite_app_charm_script = textwrap.dedent("""\
@@ -118,3 +212,21 @@ async def test_recovery(ops_test, run_action):
     await ops_test.model.wait_for_idle(status="active")
     results = await run_action("this", "get-relation-data")
     assert "relation-data" in results
+
+
+async def test_reset(ops_test, run_action):
+    app = ops_test.model.applications["other"]
+    await app.reset_config(["src-overwrite", "python-packages"])
+    await ops_test.model.wait_for_idle(status="active")
+    results = await run_action("other", "reset")
+    # the config reset has restored the src files already
+    assert json.loads(results["src"]) == {"written": 0, "removed": []}
+    assert any(
+        change["relation"] == "provide-any" and "value" in change["removed"]
+        for change in json.loads(results["relation-data"])
+    )
+    await ops_test.model.wait_for_idle(status="active")
+    results = await run_action("this", "get-relation-data")
+    relation_data = json.loads(results["relation-data"])
+    assert "value" not in relation_data[0]["unit_data"]["other/0"]
+    assert relation_data[0]["application_data"]["other"] == {}
@@ -0,0 +1,450 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import asyncio
+import base64
+import datetime
+import gzip
+import hashlib
+import json
+import pathlib
+import secrets
+import zlib
+
+import ops.testing
+import pytest
+
+import any_charm_base
+from any_charm import AnyCharm
+
+CHARM_DIR = pathlib.Path(__file__).parent.parent.parent
+
+
+class EchoCharm(AnyCharm):
+    def echo(self, *args, **kwargs):
+        return {"args": args, "kwargs": kwargs}
+
+    def fail(self):
+        raise ValueError("fail")
+
+    def count(self, limit, fail_at=None):
+        for idx in range(limit):
+            if idx == fail_at:
+                raise ValueError("fail")
+            yield idx
+
+    async def count_async(self, limit, delay=0):
+        for idx in range(limit):
+            await asyncio.sleep(delay)
+            yield idx
+
+    async def sleep(self, delay):
+        await asyncio.sleep(delay)
+        return delay
+
+
+@pytest.fixture(name="harness")
+def harness_fixture(tmp_path):
+    harness = ops.testing.Harness(
+        EchoCharm,
+        meta=(CHARM_DIR / "metadata.yaml").read_text(),
+        actions=(CHARM_DIR / "actions.yaml").read_text(),
+        config=(CHARM_DIR / "config.yaml").read_text(),
+    )
+    harness.framework.charm_dir = tmp_path
+    harness.begin()
+    yield harness
+    harness.cleanup()
+
+
+@pytest.fixture(name="goal_state")
+def goal_state_fixture(harness, monkeypatch):
+    """Fake goal-state derived from the relations added to the harness."""
+
+    def _goal_state():
+        goal = ops.hookcmds.Goal(status="active", since=datetime.datetime.now())
+        relations = {}
+        for endpoint in harness.charm.relation_endpoints:
+            for relation in harness.model.relations[endpoint]:
+                relations.setdefault(endpoint, {})[relation.app.name] = goal
+        return ops.hookcmds.GoalState(units={harness.charm.unit.name: goal}, relations=relations)
+
+    monkeypatch.setattr(ops.hookcmds, "goal_state", _goal_state)
+
+
+def test_relation_endpoints(harness):
+    endpoints = harness.charm.relation_endpoints
+    assert "provide-any" in endpoints
+    assert "require-any" in endpoints
+    assert "peer-any" not in endpoints
+    assert harness.charm.interface_endpoints["any"] == ["provide-any", "require-any"]
+
+
+def test_active_relations(harness, goal_state):
+    relation_id = harness.add_relation("provide-any", "other")
+    assert harness.charm.active_relation_endpoints == ["provide-any"]
+    assert [r.id for r in harness.charm.active_relations] == [relation_id]
+    assert harness.charm.hook_tool_calls["goal-state"] == 1
+
+
+def test_get_relation_data_filter(harness, goal_state):
+    harness.add_relation("provide-any", "other", app_data={"a": "1", "b": "2"})
+    harness.add_relation("require-any", "another", unit_data={"c": "3"})
+    results = harness.run_action(
+        "get-relation-data", {"relation": "provide-any", "keys": '["a"]', "data": "application"}
+    ).results
+    assert json.loads(results["relation-data"]) == [
+        {
+            "relation": "provide-any",
+            "other_application_name": "other",
+            "application_data": {"any-charm": {}, "other": {"a": "1"}},
+        }
+    ]
+    results = harness.run_action("get-relation-data", {"application": "another"}).results
+    relation_data = json.loads(results["relation-data"])
+    assert [r["relation"] for r in relation_data] == ["require-any"]
+    assert relation_data[0]["unit_data"] == {"another/0": {"c": "3"}, "any-charm/0": {}}
+
+
+def test_get_relation_data_without_goal_state(harness):
+    relation_id = harness.add_relation("provide-any", "a", app_data={"x": "1"})
+    results = harness.run_action("get-relation-data").results
+    relation_data = json.loads(results["relation-data"])
+    assert [r["other_application_name"] for r in relation_data] == ["a"]
+    assert relation_data[0]["application_data"]["a"] == {"x": "1"}
+    assert harness.charm.app_unit_names == ["any-charm/0"]
+    assert harness.model.get_relation("provide-any", relation_id) in harness.charm.active_relations
+
+
+def test_get_relation_data_pagination(harness, goal_state):
+    for app in ("a", "b", "c"):
+        harness.add_relation("provide-any", app)
+    apps = []
+    params = {"limit": 2}
+    while True:
+        results = harness.run_action("get-relation-data", params).results
+        apps.extend(r["other_application_name"] for r in json.loads(results["relation-data"]))
+        if "next-cursor" not in results:
+            break
+        params["cursor"] = results["next-cursor"]
+    assert apps == ["a", "b", "c"]
+
+
+def test_get_relation_data_resolve_secrets(harness, goal_state, monkeypatch):
+    harness.set_leader(True)
+    relation_id = harness.add_relation("provide-any", "a", unit_data={"x": "1"})
+    remote_secret = harness.add_model_secret("a", {"password": "1"})
+    harness.grant_secret(remote_secret, "any-charm")
+    local_secret = harness.charm.app.add_secret({"token": "t"}).id
+    missing_secret = "secret:" + "0" * 20
+    harness.update_relation_data(
+        relation_id, "a", {"password": remote_secret, "again": remote_secret}
+    )
+    harness.update_relation_data(
+        relation_id, "any-charm", {"token": local_secret, "missing": missing_secret}
+    )
+    backend = harness.model._backend
+    secret_get = backend.secret_get
+    secret_gets = []
+
+    def _secret_get(**kwargs):
+        secret_gets.append(kwargs["id"])
+        return secret_get(**kwargs)
+
+    monkeypatch.setattr(backend, "secret_get", _secret_get)
+
+    def _secrets():
+        results = harness.run_action("get-relation-data", {"resolve-secrets": True}).results
+        return json.loads(results["secrets"])
+
+    secrets_result = _secrets()
+    assert secrets_result[remote_secret] == {"content": {"password": "1"}}
+    assert secrets_result[local_secret] == {"content": {"token": "t"}}
+    assert "error" in secrets_result[missing_secret]
+    assert set(secret_gets) == {remote_secret, local_secret, missing_secret}
+
+    secret_gets.clear()
+    assert _secrets() == secrets_result
+    assert set(secret_gets) == {local_secret, missing_secret}
+
+    harness.set_secret_content(remote_secret, {"password": "2"})
+    secret_gets.clear()
+    assert _secrets()[remote_secret] == {"content": {"password": "2"}}
+    assert remote_secret in secret_gets
+    cache_path = harness.charm.charm_dir / ".any-charm-secret-cache"
+    assert cache_path.stat().st_mode & 0o777 == 0o600
+
+
+@pytest.mark.parametrize("stop_on_error", [True, False])
+def test_rpc_batch(harness, stop_on_error):
+    calls = [
+        {"method": "echo", "args": [1]},
+        {"method": "fail"},
+        {"method": "echo", "kwargs": {"a": "b"}},
+    ]
+    results = harness.run_action(
+        "rpc", {"calls": json.dumps(calls), "stop-on-error": stop_on_error}
+    ).results
+    expected = [{"return": {"args": [1], "kwargs": {}}}, {"error": "ValueError('fail')"}]
+    if not stop_on_error:
+        expected.append({"return": {"args": [], "kwargs": {"a": "b"}}})
+    assert json.loads(results["return"]) == expected
+
+
+def test_rpc_result_encoding(harness, tmp_path, monkeypatch):
+    monkeypatch.setattr(any_charm_base, "RESULT_FILE_DIR", tmp_path)
+    payload = [secrets.token_hex(64) for _ in range(2000)]
+    params = {"method": "echo", "args": json.dumps(payload)}
+
+    results = harness.run_action("rpc", {**params, "result-encoding": "zlib"}).results
+    chunks = int(results["return-chunks"])
+    assert chunks > 1
+    encoded = "".join(results[f"return-chunk-{idx}"] for idx in range(chunks))
+    assert json.loads(zlib.decompress(base64.b64decode(encoded)))["args"] == payload
+
+    results = harness.run_action("rpc", {**params, "result-encoding": "file"}).results
+    content = pathlib.Path(results["return-path"]).read_bytes()
+    assert hashlib.sha256(content).hexdigest() == results["return-sha256"]
+    assert json.loads(gzip.decompress(content))["args"] == payload
+
+
+@pytest.mark.parametrize("result_encoding", ["json", "zlib", "file"])
+def test_rpc_stream(harness, tmp_path, monkeypatch, result_encoding):
+    monkeypatch.setattr(any_charm_base, "RESULT_FILE_DIR", tmp_path)
+    monkeypatch.setattr(any_charm_base, "RPC_PROGRESS_INTERVAL", 0)
+
+    def _rpc(params):
+        output = harness.run_action("rpc", {**params, "result-encoding": result_encoding})
+        results = output.results
+        if result_encoding == "zlib":
+            chunks = "".join(
+                results[f"return-chunk-{idx}"] for idx in range(int(results["return-chunks"]))
+            )
+            encoded = zlib.decompress(base64.b64decode(chunks))
+        elif result_encoding == "file":
+            encoded = gzip.decompress(pathlib.Path(results["return-path"]).read_bytes())
+        else:
+            encoded = results["return"]
+        return results["return-status"], json.loads(encoded), output.logs
+
+    status, result, logs = _rpc({"method": "count", "args": "[3]"})
+    assert (status, result) == ("complete", [0, 1, 2])
+    assert logs[-1] == "count: 3 items, latest 2"
+    assert _rpc({"method": "count_async", "args": "[3]"})[:2] == ("complete", [0, 1, 2])
+    assert _rpc({"method": "sleep", "args": "[0]"})[:2] == ("complete", 0)
+
+    status, result, _ = _rpc({"method": "count_async", "args": "[100, 0.01]", "deadline": 0.1})
+    assert status == "deadline-exceeded"
+    assert 0 < len(result) < 100
+    assert result == list(range(len(result)))
+    assert _rpc({"method": "sleep", "args": "[10]", "deadline": 0.01})[:2] == (
+        "deadline-exceeded",
+        None,
+    )
+
+    calls = [
+        {"method": "echo"},
+        {"method": "count", "args": [3, 2]},
+        {"method": "count", "args": [2]},
+        {"method": "count_async", "args": [100, 0.01]},
+        {"method": "echo"},
+    ]
+    params = {"calls": json.dumps(calls), "stop-on-error": False, "deadline": 0.1}
+    status, result, _ = _rpc(params)
+    assert status == "deadline-exceeded"
+    assert result[:3] == [
+        {"return": {"args": [], "kwargs": {}}},
+        {"return": [0, 1], "error": "ValueError('fail')"},
+        {"return": [0, 1]},
+    ]
+    assert result[3]["status"] == "deadline-exceeded"
+    assert len(result) == 4
+
+
+def test_get_hook_stats(harness, tmp_path):
+    records = [
+        {"event": "start", "phases": {"total": duration}, "hook-tool-calls": {"is-leader": 1}}
+        for duration in range(1, 101)
+    ]
+    (tmp_path / any_charm_base.HOOK_STATS_FILENAME).write_text(
+        "".join(json.dumps(record) + "\n" for record in records)
+    )
+    results = harness.run_action("get-hook-stats").results
+    assert json.loads(results["hook-stats"]) == {
+        "start": {
+            "count": 100,
+            "hook-tool-calls": {"count": 100, "p50": 1, "p95": 1, "max": 1},
+            "phases": {"total": {"count": 100, "p50": 50, "p95": 95, "max": 100}},
+        }
+    }
+
+    harness.run_action("profile-hooks", {"event": "start", "count": 2})
+    request = json.loads((tmp_path / any_charm_base.PROFILE_REQUEST_FILENAME).read_text())
+    assert request == {"event": "start", "count": 2}
+
+
+def test_get_relation_changes(harness, monkeypatch):
+    relation_id = harness.add_relation("provide-any", "other", app_data={"a": "1"})
+    harness.add_relation_unit(relation_id, "other/0")
+    results = harness.run_action("get-relation-changes").results
+    changes = json.loads(results["relation-changes"])
+    assert [(c["entity"], c["changed"], c["removed"]) for c in changes] == [
+        ("other", {"a": "1"}, [])
+    ]
+    assert results["truncated"] == "false"
+
+    cursor = results["cursor"]
+    harness.update_relation_data(relation_id, "other", {"a": "1", "b": "2"})
+    harness.update_relation_data(relation_id, "other/0", {"c": "3"})
+    harness.update_relation_data(relation_id, "other", {"b": ""})
+    harness.remove_relation_unit(relation_id, "other/0")
+    results = harness.run_action("get-relation-changes", {"cursor": cursor}).results
+    changes = json.loads(results["relation-changes"])
+    assert [(c["event"], c["entity"], c["changed"], c["removed"]) for c in changes] == [
+        ("changed", "other", {"b": "2"}, []),
+        ("changed", "other/0", {"c": "3"}, []),
+        ("changed", "other", {}, ["b"]),
+        ("departed", "other/0", {}, ["c"]),
+    ]
+    results = harness.run_action("get-relation-changes", {"cursor": results["cursor"]}).results
+    assert json.loads(results["relation-changes"]) == []
+
+    monkeypatch.setattr(any_charm_base, "RELATION_CHANGES_MAX_SIZE", 1)
+    monkeypatch.setattr(any_charm_base, "RELATION_CHANGES_KEEP", 2)
+    another_relation_id = harness.add_relation("require-any", "another", app_data={"d": "4"})
+    harness.remove_relation(another_relation_id)
+    results = harness.run_action("get-relation-changes", {"cursor": cursor}).results
+    changes = json.loads(results["relation-changes"])
+    assert [(c["event"], c["entity"], c["changed"], c["removed"]) for c in changes] == [
+        ("changed", "another", {"d": "4"}, []),
+        ("broken", "another", {}, ["d"]),
+    ]
+    assert results["truncated"] == "true"
+
+
+def test_update_relation_data(harness, goal_state, monkeypatch):
+    harness.set_leader(True)
+    relation_a = harness.add_relation("provide-any", "a")
+    relation_b = harness.add_relation("provide-any", "b")
+    harness.update_relation_data(relation_a, "any-charm/0", {"x": "1", "y": "2"})
+    backend = harness.model._backend
+    update_relation_data = backend.update_relation_data
+    relation_sets = []
+
+    def _update_relation_data(relation_id, entity, data, **kwargs):
+        relation_sets.append((relation_id, entity.name, dict(data)))
+        update_relation_data(relation_id, entity, data, **kwargs)
+
+    monkeypatch.setattr(backend, "update_relation_data", _update_relation_data)
+
+    def _rpc(updates):
+        results = harness.run_action(
+            "rpc", {"method": "update_relation_data", "args": json.dumps([updates])}
+        ).results
+        return json.loads(results["return"])
+
+    updates = [
+        {"relation": "provide-any", "data": {"x": "1", "z": "3"}},
+        {"relation_id": relation_a, "data": {"y": None}},
+        {"relation_id": relation_b, "app": True, "data": {"k": "v"}},
+    ]
+    assert _rpc(updates) == [
+        {
+            "relation": "provide-any",
+            "relation_id": relation_a,
+            "databag": "any-charm/0",
+            "changed": {"z": "3"},
+            "removed": ["y"],
+        },
+        {
+            "relation": "provide-any",
+            "relation_id": relation_b,
+            "databag": "any-charm/0",
+            "changed": {"x": "1", "z": "3"},
+            "removed": [],
+        },
+        {
+            "relation": "provide-any",
+            "relation_id": relation_b,
+            "databag": "any-charm",
+            "changed": {"k": "v"},
+            "removed": [],
+        },
+    ]
+    assert relation_sets == [
+        (relation_a, "any-charm/0", {"z": "3", "y": ""}),
+        (relation_b, "any-charm/0", {"x": "1", "z": "3"}),
+        (relation_b, "any-charm", {"k": "v"}),
+    ]
+    assert _rpc(updates) == []
+    assert len(relation_sets) == 3
+
+    changes = _rpc([{"relation_id": relation_a, "data": {"x": "1"}, "replace": True}])
+    assert [(change["changed"], change["removed"]) for change in changes] == [({}, ["z"])]
+    assert harness.get_relation_data(relation_a, "any-charm/0") == {"x": "1"}
+
+
+def test_relation_load(harness, goal_state):
+    relation_ids = [harness.add_relation("provide-any", app) for app in ("a", "b")]
+    params = {"keys": 2, "value-size": 8, "iterations": 3, "rate": 100}
+    results = harness.run_action("relation-load", params).results
+    load = json.loads(results["load"])
+    assert (load["relations"], load["writes"], load["bytes"]) == (2, 6, 96)
+    assert load["duration"] >= 0.02
+    assert json.loads(results["latency"])["count"] == 6
+    for relation_id in relation_ids:
+        data = harness.get_relation_data(relation_id, "any-charm/0")
+        assert sorted(data) == ["load-0", "load-1"]
+        assert len(data["load-0"]) == 8
+
+    peer_relation_id = harness.add_relation("peer-any", "any-charm")
+    harness.add_relation_unit(peer_relation_id, "any-charm/1")
+    harness.run_action("relation-load", {"iterations": 1, "peers": True})
+    request = json.loads(
+        harness.get_relation_data(peer_relation_id, "any-charm/0")[
+            any_charm_base.RELATION_LOAD_REQUEST_KEY
+        ]
+    )
+    assert request["load"]["iterations"] == 1
+    peer_request = json.dumps({"load": {"keys": 1, "endpoints": ["provide-any"]}, "nonce": "1"})
+    harness.update_relation_data(
+        peer_relation_id, "any-charm/1", {any_charm_base.RELATION_LOAD_REQUEST_KEY: peer_request}
+    )
+    harness.update_config({"relation-load": json.dumps({"keys": 1})})
+    results = harness.run_action("relation-load", {"iterations": 0}).results
+    assert "load" not in results
+    assert json.loads(results["latency"])["count"] == 12
+
+
+def test_reset(harness, goal_state, tmp_path):
+    harness.set_leader(True)
+    relation_id = harness.add_relation("provide-any", "a")
+    peer_relation_id = harness.add_relation("peer-any", "any-charm")
+    harness.update_relation_data(
+        relation_id, "any-charm/0", {"private-address": "10.0.0.1", "x": "1", "y": "2"}
+    )
+    harness.update_relation_data(relation_id, "any-charm", {"k": "v"})
+    harness.update_relation_data(peer_relation_id, "any-charm/0", {"p": "1"})
+    (tmp_path / any_charm_base.RELATION_CHANGES_FILENAME).write_text("{}\n")
+    report = {"src": {"written": 2, "removed": ["extra.py"]}, "dynamic-packages": True}
+    (tmp_path / any_charm_base.RESET_REPORT_FILENAME).write_text(json.dumps(report))
+
+    results = harness.run_action("reset").results
+    assert json.loads(results["src"]) == report["src"]
+    assert results["dynamic-packages"] == "reset"
+    assert [
+        (c["relation_id"], c["databag"], c["removed"])
+        for c in json.loads(results["relation-data"])
+    ] == [
+        (relation_id, "any-charm/0", ["x", "y"]),
+        (relation_id, "any-charm", ["k"]),
+        (peer_relation_id, "any-charm/0", ["p"]),
+    ]
+    assert json.loads(results["cleared"]) == [any_charm_base.RELATION_CHANGES_FILENAME]
+    assert harness.get_relation_data(relation_id, "any-charm/0") == {"private-address": "10.0.0.1"}
+    assert harness.get_relation_data(relation_id, "any-charm") == {}
+    assert not (tmp_path / any_charm_base.RESET_REPORT_FILENAME).exists()
+
+    results = harness.run_action("reset").results
+    assert results["dynamic-packages"] == "unchanged"
+    assert json.loads(results["relation-data"]) == []
@@ -1,12 +1,27 @@
 # Copyright 2024 Canonical Ltd.
 # See LICENSE file for licensing details.
 
+import base64
+import hashlib
 import importlib.util
+import io
+import json
 import pathlib
 import secrets
 import shutil
+import socket
+import subprocess
 import sys
-import tempfile
+import tarfile
+import textwrap
+import time
+import zipfile
+
+import pytest
+
+CHARM_DIR = pathlib.Path(__file__).parent.parent.parent
+# modules only needed when the config changed, they must not be imported by every hook
+LAZY_IMPORTED_MODULES = {"charmhelpers", "packaging", "yaml", "zipfile", "compileall"}
 
 
 def import_module(path: pathlib.Path):
@@ -18,27 +33,488 @@ def import_module(path: pathlib.Path):
     return module
 
 
-def test_preserve_original():
-    charm_dir = pathlib.Path(__file__).parent.parent.parent
-    src_dir = charm_dir / "src"
-    with tempfile.TemporaryDirectory() as tmp:
-        tmp_dir = pathlib.Path(tmp)
-        tmp_src = tmp_dir / "src"
-        tmp_src.mkdir(exist_ok=True)
-        tmp_src_charm = tmp_src / "charm.py"
-        shutil.copy(charm_dir / "wheelhouse.txt", tmp_dir)
-
-        original = {}
-        for file in src_dir.glob("*.py"):
-            shutil.copy(file, tmp_src)
-            if file.name != "charm.py":
-                original[file.name] = file.read_text()
-
-        charm = import_module(tmp_src_charm)
-        charm.preserve_original()
-        charm = import_module(tmp_src_charm)
-        assert charm.original == original
-
-        charm.preserve_original()
-        charm = import_module(tmp_src_charm)
-        assert charm.original == original
+@pytest.fixture(name="tmp_src")
+def tmp_src_fixture(tmp_path):
+    """Copy of the any-charm src directory in a temporary charm directory."""
+    tmp_src = tmp_path / "src"
+    tmp_src.mkdir(exist_ok=True)
+    for file in (CHARM_DIR / "src").glob("*.py"):
+        shutil.copy(file, tmp_src)
+    return tmp_src
+
+
+def import_charm(tmp_src: pathlib.Path, monkeypatch, config=None):
+    charm = import_module(tmp_src / "charm.py")
+    if config is not None:
+        monkeypatch.setattr(charm, "charm_config", lambda: config)
+    return charm
+
+
+def import_time(statement: str):
+    """Run an import statement in a fresh interpreter, get imported modules and total seconds."""
+    output = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", statement],
+        cwd=CHARM_DIR / "src",
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stderr
+    modules = set()
+    total = 0
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        modules.add(name.strip().split(".")[0])
+        if not name[1:].startswith(" "):
+            total += int(cumulative)
+    return modules, total / 1e6
+
+
+def test_import_time():
+    charm_modules, charm_import_time = import_time("import charm")
+    ops_modules, ops_import_time = import_time("import ops.main")
+    assert not (charm_modules - ops_modules) & LAZY_IMPORTED_MODULES
+    assert charm_import_time < ops_import_time * 1.5 + 0.05
+
+
+def test_preserve_original(tmp_src, monkeypatch):
+    original = {
+        file.name: file.read_text() for file in tmp_src.glob("*.py") if file.name != "charm.py"
+    }
+
+    charm = import_charm(tmp_src, monkeypatch)
+    charm.preserve_original()
+    charm = import_charm(tmp_src, monkeypatch)
+    assert charm.state.original == original
+
+    charm.preserve_original()
+    charm = import_charm(tmp_src, monkeypatch)
+    assert charm.state.original == original
+
+
+def test_prelude_fast_path(tmp_src, monkeypatch):
+    config = {"src-overwrite": json.dumps({"extra.py": "x = 1"}), "python-packages": ""}
+    charm = import_charm(tmp_src, monkeypatch, config)
+    charm.prelude()
+    assert (tmp_src / "extra.py").read_text() == "x = 1"
+
+    def fail(*args, **kwargs):
+        raise AssertionError("prelude should take the fast path")
+
+    charm = import_charm(tmp_src, monkeypatch, config)
+    monkeypatch.setattr(charm, "src_overwrite", fail)
+    monkeypatch.setattr(charm, "install_packages", fail)
+    # juju-log is a subprocess, the fast path of a charm without hook-stats doesn't run it
+    monkeypatch.setattr(charm, "juju_log", fail)
+    charm.prelude()
+
+    config = {**config, "src-overwrite": json.dumps({"extra.py": "x = 2"})}
+    charm = import_charm(tmp_src, monkeypatch, config)
+    charm.prelude()
+    assert (tmp_src / "extra.py").read_text() == "x = 2"
+
+
+def test_src_overwrite_incremental(tmp_src, monkeypatch):
+    config = {
+        "src-overwrite": json.dumps({"extra.py": "x = 1", "pkg/mod.py": "y = 1"}),
+        "python-packages": "",
+    }
+    charm = import_charm(tmp_src, monkeypatch, config)
+    charm.prelude()
+    assert (tmp_src / "pkg" / "mod.py").read_text() == "y = 1"
+    extra_mtime = (tmp_src / "extra.py").stat().st_mtime_ns
+
+    config = {**config, "src-overwrite": json.dumps({"extra.py": "x = 1", "charm.py": ""})}
+    charm = import_charm(tmp_src, monkeypatch, config)
+    charm.prelude()
+    assert (tmp_src / "extra.py").stat().st_mtime_ns == extra_mtime
+    assert not (tmp_src / "pkg" / "mod.py").exists()
+    assert (tmp_src / "charm.py").read_text()
+    assert set(charm.state.manifest) == set(charm.state.original) | {"extra.py"}
+
+    # a file edited outside of the charm is written again on the next config change
+    (tmp_src / "extra.py").write_text("edited")
+    config = {**config, "src-overwrite": json.dumps({"extra.py": "x = 1", "y.py": ""})}
+    charm = import_charm(tmp_src, monkeypatch, config)
+    charm.prelude()
+    assert (tmp_src / "extra.py").read_text() == "x = 1"
+
+    # file map keys are confined to the src directory like archive members
+    config = {**config, "src-overwrite": json.dumps({"../x.py": ""})}
+    charm = import_charm(tmp_src, monkeypatch, config)
+    with pytest.raises(ValueError):
+        charm.prelude()
+    assert not (tmp_src.parent / "x.py").exists()
+
+
+def src_overwrite_archive(files, archive_format):
+    buffer = io.BytesIO()
+    if archive_format == "zip":
+        with zipfile.ZipFile(buffer, "w") as archive:
+            for path, content in files.items():
+                archive.writestr(path, content)
+    else:
+        with tarfile.open(fileobj=buffer, mode=f"w:{archive_format}") as archive:
+            for path, content in files.items():
+                info = tarfile.TarInfo(path)
+                info.size = len(content)
+                archive.addfile(info, io.BytesIO(content.encode("utf-8")))
+    content = buffer.getvalue()
+    header = f"any-charm-archive/v1 sha256={hashlib.sha256(content).hexdigest()}"
+    return f"{header}\n{base64.encodebytes(content).decode('ascii')}"
+
+
+@pytest.mark.parametrize("archive_format", ["gz", "xz", "zip"])
+def test_src_overwrite_archive(tmp_src, monkeypatch, archive_format):
+    files = {"any_charm.py": "x = 1", "vendored/lib/mod.py": "y = 1"}
+    config = {"src-overwrite": src_overwrite_archive(files, archive_format), "python-packages": ""}
+    charm = import_charm(tmp_src, monkeypatch, config)
+    charm.prelude()
+    assert (tmp_src / "any_charm.py").read_text() == "x = 1"
+    assert (tmp_src / "vendored" / "lib" / "mod.py").read_text() == "y = 1"
+    assert set(charm.state.manifest) == set(charm.state.original) | {"vendored/lib/mod.py"}
+
+    def _decode(*args):
+        raise AssertionError("archive decoded again")
+
+    monkeypatch.setattr(charm, "read_src_overwrite_archive", _decode)
+    charm.state.update(fingerprint="")
+    charm.prelude()
+
+    config = {**config, "src-overwrite": src_overwrite_archive({"../x.py": ""}, archive_format)}
+    charm = import_charm(tmp_src, monkeypatch, config)
+    with pytest.raises(ValueError):
+        charm.prelude()
+    tampered = config["src-overwrite"].replace("sha256=", "sha256=0")
+    with pytest.raises(ValueError):
+        charm.read_src_overwrite_archive(tampered, charm.src_overwrite_archive_digest(tampered))
+    for header in (
+        "any-charm-archive/v1",
+        "any-charm-archive/v1 sha256",
+        "any-charm-archive/v1 x=1",
+    ):
+        with pytest.raises(ValueError, match="sha256=<hex digest>"):
+            charm.src_overwrite_archive_digest(f"{header}\n")
+
+
+def test_prelude_reset(tmp_src, tmp_path, monkeypatch):
+    original = (tmp_src / "any_charm.py").read_text()
+    config = {
+        "src-overwrite": json.dumps({"any_charm.py": "broken", "extra.py": "x = 1"}),
+        "python-packages": "a",
+    }
+    charm = import_charm(tmp_src, monkeypatch, config)
+    monkeypatch.setattr(charm, "PACKAGE_STORE_DIR", tmp_path / "store")
+    monkeypatch.setattr(charm, "pip_install", lambda requirements, target: None)
+    charm.prelude()
+    assert (tmp_src / "any_charm.py").read_text() == "broken"
+
+    configured = dict(config)
+    monkeypatch.setenv("JUJU_DISPATCH_PATH", "actions/reset")
+    charm.prelude()
+    assert (tmp_src / "any_charm.py").read_text() == original
+    assert not (tmp_src / "extra.py").exists()
+    assert charm.charm_config() == configured
+    assert charm.DYNAMIC_PACKAGES_PATH.resolve().name == charm.requirements_key("")
+    report = json.loads(charm.RESET_REPORT_PATH.read_text())
+    assert report == {"src": {"written": 1, "removed": ["extra.py"]}, "dynamic-packages": True}
+
+    # the config values are applied again unless they have been reset as well
+    config = {**config, **charm.RESET_CONFIG}
+    charm = import_charm(tmp_src, monkeypatch, config)
+    monkeypatch.setenv("JUJU_DISPATCH_PATH", "hooks/config-changed")
+    monkeypatch.setattr(charm, "install_packages", None)
+    charm.prelude()
+
+
+def test_src_overwrite_compile_bytecode(tmp_src, monkeypatch):
+    config = {"src-overwrite": json.dumps({"pkg/mod.py": "y = 1"}), "python-packages": ""}
+    charm = import_charm(tmp_src, monkeypatch, config)
+    charm.prelude()
+    pyc = tmp_src / "pkg" / "__pycache__" / f"mod.{sys.implementation.cache_tag}.pyc"
+    # flags of a checked hash-based pyc
+    assert pyc.read_bytes()[4:8] == (3).to_bytes(4, "little")
+
+
+def test_state_charm_upgrade(tmp_src, monkeypatch):
+    config = {"src-overwrite": json.dumps({"extra.py": "x = 1"}), "python-packages": ""}
+    charm = import_charm(tmp_src, monkeypatch, config)
+    charm.prelude()
+    packages = charm.state.packages
+
+    charm_py = tmp_src / "charm.py"
+    charm_py.write_text(charm_py.read_text() + "\n# upgraded\n")
+    (tmp_src / "any_charm.py").write_text("# upgraded\n")
+    charm = import_charm(tmp_src, monkeypatch, config)
+    assert charm.state.fingerprint == ""
+    assert charm.state.packages == packages
+    assert charm.state.manifest == {"extra.py": charm.text_digest("x = 1")}
+    charm.prelude()
+    assert "extra.py" not in charm.state.original
+    assert charm.state.original["any_charm.py"] == "# upgraded\n"
+
+
+def test_state_src_upgrade(tmp_src, monkeypatch):
+    config = {"src-overwrite": json.dumps({"any_charm.py": "x = 1"}), "python-packages": ""}
+    charm = import_charm(tmp_src, monkeypatch, config)
+    charm.prelude()
+    assert (tmp_src / "any_charm.py").read_text() == "x = 1"
+
+    # an upgrade changing only the pristine src files other than charm.py
+    (tmp_src / "any_charm.py").write_text("# upgraded\n")
+    (tmp_src / "any_charm_base.py").write_text("# upgraded base\n")
+    monkeypatch.setenv("JUJU_DISPATCH_PATH", "hooks/upgrade-charm")
+    charm = import_charm(tmp_src, monkeypatch, config)
+    charm.prelude()
+    assert (tmp_src / "any_charm.py").read_text() == "x = 1"
+    assert charm.state.original["any_charm.py"] == "# upgraded\n"
+    assert charm.state.original["any_charm_base.py"] == "# upgraded base\n"
+
+    # a retried upgrade-charm hook keeps the state
+    original = charm.state.original
+    charm = import_charm(tmp_src, monkeypatch, config)
+    charm.prelude()
+    assert charm.state.original == original
+
+    config = {**config, "src-overwrite": "{}"}
+    charm = import_charm(tmp_src, monkeypatch, config)
+    monkeypatch.setenv("JUJU_DISPATCH_PATH", "hooks/config-changed")
+    charm.prelude()
+    assert (tmp_src / "any_charm.py").read_text() == "# upgraded\n"
+
+
+def test_install_packages_store(tmp_src, tmp_path, monkeypatch):
+    installed = []
+
+    def pip_install(requirements, target):
+        installed.append(requirements)
+        (target / "shared.py").write_text("shared = True")
+        (target / f"{requirements}.py").write_text(requirements)
+
+    config = {"src-overwrite": "{}", "python-packages": "a"}
+    charm = import_charm(tmp_src, monkeypatch, config)
+    monkeypatch.setattr(charm, "PACKAGE_STORE_DIR", tmp_path / "store")
+    monkeypatch.setattr(charm, "pip_install", pip_install)
+    charm.install_packages()
+    config["python-packages"] = "b"
+    charm.install_packages()
+    config["python-packages"] = "a"
+    charm.install_packages()
+
+    assert installed == ["a", "b"]
+    dynamic_packages = charm.DYNAMIC_PACKAGES_PATH
+    assert dynamic_packages.resolve().name == charm.requirements_key("a")
+    assert (dynamic_packages / "a.py").exists()
+    assert not (dynamic_packages / "b.py").exists()
+    assert (dynamic_packages / "shared.py").stat().st_nlink == 3
+    assert (dynamic_packages / "__pycache__").is_dir()
+
+    monkeypatch.setattr(charm, "PACKAGE_STORE_MAX_SIZE", 0)
+    config["python-packages"] = "c"
+    charm.install_packages()
+    envs = {env.name for env in (tmp_path / "store" / "envs").iterdir()}
+    assert envs == {charm.requirements_key("c")}
+    assert (dynamic_packages / "shared.py").stat().st_nlink == 2
+
+
+def test_install_packages_store_wiped(tmp_src, tmp_path, monkeypatch):
+    config = {"src-overwrite": "{}", "python-packages": "a"}
+    charm = import_charm(tmp_src, monkeypatch, config)
+    monkeypatch.setattr(charm, "PACKAGE_STORE_DIR", tmp_path / "store")
+    monkeypatch.setattr(
+        charm, "pip_install", lambda requirements, target: (target / "a.py").write_text("")
+    )
+    charm.prelude()
+    assert (charm.DYNAMIC_PACKAGES_PATH / "a.py").exists()
+
+    # the store doesn't persist with the charm state, like in a restarted k8s charm container
+    shutil.rmtree(tmp_path / "store")
+    charm = import_charm(tmp_src, monkeypatch, config)
+    monkeypatch.setattr(charm, "PACKAGE_STORE_DIR", tmp_path / "store")
+    monkeypatch.setattr(
+        charm, "pip_install", lambda requirements, target: (target / "a.py").write_text("")
+    )
+    charm.prelude()
+    assert (charm.DYNAMIC_PACKAGES_PATH / "a.py").exists()
+
+
+def build_wheel(wheelhouse: pathlib.Path, name: str, version: str, requires=()):
+    with zipfile.ZipFile(wheelhouse / f"{name}-{version}-py3-none-any.whl", "w") as wheel:
+        wheel.writestr(f"{name}/__init__.py", f"VERSION = {version!r}")
+        wheel.writestr(f"{name}-{version}.data/scripts/{name}", "#!python")
+        metadata = f"Name: {name}\nVersion: {version}\n"
+        metadata += "".join(f"Requires-Dist: {req}\n" for req in requires)
+        wheel.writestr(f"{name}-{version}.dist-info/METADATA", metadata)
+
+
+@pytest.mark.parametrize("build_index", [True, False])
+def test_install_from_wheelhouse(tmp_src, tmp_path, monkeypatch, build_index):
+    wheelhouse = tmp_path / "wheelhouse"
+    wheelhouse.mkdir()
+    build_wheel(
+        wheelhouse, "foo", "1.0", ["bar>=2", 'baz; python_version < "3"', "qux; extra == 'q'"]
+    )
+    build_wheel(wheelhouse, "bar", "1.0")
+    build_wheel(wheelhouse, "bar", "2.0")
+    build_wheel(wheelhouse, "qux", "1.0")
+    build_wheel(wheelhouse, "old", "1.0")
+    if build_index:
+        import_module(CHARM_DIR / "scripts" / "build_wheelhouse_index.py").main(wheelhouse)
+    charm = import_charm(tmp_src, monkeypatch)
+    monkeypatch.setattr(charm, "WHEELHOUSE_DIR", wheelhouse)
+    pip_installed = []
+    monkeypatch.setattr(subprocess, "check_call", lambda cmd: pip_installed.extend(cmd[-1:]))
+
+    target = tmp_path / "target"
+    charm.pip_install('foo[q]\nbar\nnotfound\nold; python_version < "3"', target)
+    assert (target / "foo" / "__init__.py").read_text() == "VERSION = '1.0'"
+    assert (target / "bar" / "__init__.py").read_text() == "VERSION = '2.0'"
+    assert (target / "qux" / "__init__.py").exists()
+    assert (target / "bin" / "foo").exists()
+    assert not (target / "baz").exists()
+    assert not (target / "old").exists()
+    assert pip_installed == ["notfound"]
+
+
+def test_overwrite_resource(tmp_src, tmp_path, monkeypatch):
+    wheels = tmp_path / "wheels"
+    wheels.mkdir()
+    build_wheel(wheels, "resourcepkg", "1.0")
+    resource = tmp_path / "overwrite.tar.gz"
+    with tarfile.open(resource, "w:gz") as archive:
+        archive.add(wheels, "wheels")
+        for path, content in {"src/any_charm.py": "x = 1", "src/lib/mod.py": "y = 1"}.items():
+            info = tarfile.TarInfo(path)
+            info.size = len(content)
+            archive.addfile(info, io.BytesIO(content.encode("utf-8")))
+    config = {"src-overwrite": json.dumps({"lib/mod.py": "y = 2"}), "python-packages": ""}
+    charm = import_charm(tmp_src, monkeypatch, config)
+    monkeypatch.setattr(charm, "PACKAGE_STORE_DIR", tmp_path / "store")
+    monkeypatch.setattr(charm, "fetch_resource", lambda: resource)
+    monkeypatch.setattr(charm, "pip_install", lambda requirements, target: None)
+    monkeypatch.setenv("JUJU_DISPATCH_PATH", "hooks/upgrade-charm")
+    charm.prelude()
+    assert (tmp_src / "any_charm.py").read_text() == "x = 1"
+    assert (tmp_src / "lib" / "mod.py").read_text() == "y = 2"
+    assert (charm.DYNAMIC_PACKAGES_PATH / "resourcepkg" / "__init__.py").exists()
+    assert charm.state.resource == charm.file_digest(resource)
+
+    unpacked = charm.RESOURCE_DIR.stat().st_ino
+    charm = import_charm(tmp_src, monkeypatch, config)
+    monkeypatch.setattr(charm, "fetch_resource", lambda: resource)
+    monkeypatch.setattr(charm, "src_overwrite", None)
+    charm.prelude()
+    assert charm.RESOURCE_DIR.stat().st_ino == unpacked
+
+    charm = import_charm(tmp_src, monkeypatch, config)
+    monkeypatch.setattr(charm, "PACKAGE_STORE_DIR", tmp_path / "store")
+    monkeypatch.setattr(charm, "fetch_resource", lambda: None)
+    monkeypatch.setattr(charm, "pip_install", lambda requirements, target: None)
+    charm.prelude()
+    assert charm.state.resource == ""
+    assert charm.state.original["any_charm.py"] == (tmp_src / "any_charm.py").read_text()
+    assert not (charm.DYNAMIC_PACKAGES_PATH / "resourcepkg").exists()
+
+
+def rpc_server_call(address: str, method: str, *args):
+    deadline = time.monotonic() + 30
+    while True:
+        try:
+            with socket.socket(socket.AF_UNIX) as client:
+                client.connect(address)
+                client.sendall(json.dumps({"method": method, "args": args}).encode() + b"\n")
+                return json.loads(client.makefile().readline())
+        except (FileNotFoundError, ConnectionRefusedError):
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def test_rpc_server(tmp_src, tmp_path, monkeypatch):
+    (tmp_src / "any_charm.py").write_text(textwrap.dedent("""\
+            from any_charm_base import AnyCharmBase
+
+            class AnyCharm(AnyCharmBase):
+                RPC_SERVER_METHODS = ("echo",)
+
+                def echo(self, *args):
+                    return args
+
+                def hidden(self):
+                    return None
+            """))
+    address = str(tmp_path / "rpc.sock")
+    config = {"src-overwrite": "{}", "python-packages": "", "rpc-server": address}
+    charm = import_charm(tmp_src, monkeypatch, config)
+    charm.state.update(fingerprint="a")
+    charm.supervise_rpc_server("config_changed")
+    pid = json.loads(charm.RPC_SERVER_STATE_PATH.read_text())["pid"]
+    try:
+        assert rpc_server_call(address, "echo", 1, "2") == {"return": [1, "2"]}
+        assert "error" in rpc_server_call(address, "hidden")
+        charm.supervise_rpc_server("update_status")
+        assert json.loads(charm.RPC_SERVER_STATE_PATH.read_text())["pid"] == pid
+
+        charm.state.update(fingerprint="b")
+        charm.supervise_rpc_server("config_changed")
+        restarted_pid = json.loads(charm.RPC_SERVER_STATE_PATH.read_text())["pid"]
+        assert restarted_pid != pid
+        assert not charm.rpc_server_running(pid)
+        pid = restarted_pid
+        assert rpc_server_call(address, "echo") == {"return": []}
+    finally:
+        charm.supervise_rpc_server("stop")
+    assert not charm.rpc_server_running(pid)
+    assert not charm.RPC_SERVER_STATE_PATH.exists()
+
+
+def test_hook_stats(tmp_src, monkeypatch):
+    charm = import_charm(tmp_src, monkeypatch)
+    monkeypatch.setenv("JUJU_DISPATCH_PATH", "actions/get-relation-data")
+    event = charm.dispatch_event_name()
+    assert event == "get_relation_data_action"
+
+    charm.PROFILE_REQUEST_PATH.write_text(json.dumps({"event": event, "count": 2}))
+    assert not charm.take_profile_request("config_changed")
+    assert charm.take_profile_request(event)
+    assert charm.take_profile_request(event)
+    assert not charm.take_profile_request(event)
+
+    class Charm:
+        def __init__(self):
+            self.hook_tool_calls = {"relation-get": 2}
+
+    charms = []
+    charm.time_charm_init(Charm, charms)
+    Charm()
+    monkeypatch.setattr(charm, "hook_tool_calls", {"config-get": 1, "relation-get": 1})
+    assert "charm-init" in charm.phase_timings
+    monkeypatch.setattr(charm, "HOOK_STATS_MAX_SIZE", 1)
+    monkeypatch.setattr(charm, "HOOK_STATS_KEEP", 3)
+    for _ in range(5):
+        charm.record_hook_stats(event, charms)
+    records = [json.loads(line) for line in charm.HOOK_STATS_PATH.read_text().splitlines()]
+    assert len(records) == 3
+    assert records[0]["hook-tool-calls"] == {"config-get": 1, "relation-get": 3}
+
+
+def test_benchmark_fake_juju(tmp_path):
+    benchmark = import_module(CHARM_DIR / "tests" / "benchmark" / "benchmark.py")
+    fake_juju = benchmark.FakeJuju(tmp_path, latency=0)
+    fake_juju.model["relations"] = benchmark.relations_model(apps=2, units=2)
+    fake_juju.dispatch("hooks/config-changed")
+    result = fake_juju.dispatch("actions/get-relation-data")
+    assert result.hook_tool_calls["goal-state"] == 1
+    assert result.hook_tool_calls["relation-get"] == 10
+    assert result.hook_tool_calls["relation-ids"] == 2
+    assert result.phases["prelude"] < result.phases["total"]
+    hook_stats = (fake_juju.charm_dir / ".any-charm-hook-stats").read_text(encoding="utf-8")
+    recorded_calls = json.loads(hook_stats.splitlines()[-1])["hook-tool-calls"]
+    assert recorded_calls == {"config-get": 1, "juju-log": 1, "goal-state": 1}
+    assert result.peak_memory > 0
+    fake_juju.model["config"]["relation-load"] = json.dumps({"keys": 1})
+    result = fake_juju.dispatch("hooks/update-status")
+    # the prelude and ops read the config independently
+    assert result.hook_tool_calls["config-get"] == 2
+    assert result.hook_tool_calls["relation-set"] == 2